@@ -50,7 +50,7 @@ def get_curves(source: str, query: Dict[str, Any] = {}):
 def get_trait(source: str, trait_name: str, query: Dict[str, Any] = {}, skip_failed=True):
     trait_results = []
     if source.startswith("mongodb"):
-        trait_results = database.get_trait_results(database.connect(source), trait_name, query)
+        trait_results = database.get_trait_results(database.connect(source), trait_name, query, skip_failed=skip_failed)
     elif source.startswith("http"):
         args = []
         for key in query:
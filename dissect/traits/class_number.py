@@ -8,6 +8,9 @@ class ClassNumberTrait(Trait):
     OUTPUT = {"upper": (int, "Upper"), "lower": (int, "Lower")}
     DEFAULT_PARAMS = {}
 
+    def factorization_inputs(self, curve, params):
+        return [curve.extended_frobenius_disc()]
+
     def compute(self, curve, params):
         """
         Computes the lower and upper bound of class number of the maximal order of the endomorphism algebra
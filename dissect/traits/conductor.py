@@ -5,6 +5,13 @@ from dissect.traits import Trait
 TRAIT_TIMEOUT = 60
 
 
+def conductor_ratio_sqrt(curve, deg):
+    """Square root of the ratio of Frobenius discriminants over the deg-th extension and the base field"""
+    from sage.all import ZZ, sqrt
+
+    return ZZ(sqrt(curve.extended_frobenius_disc(deg) / curve.extended_frobenius_disc()))
+
+
 class ConductorTrait(Trait):
     NAME = "conductor"
     DESCRIPTION = "Factorization of ratio of the maximal conductors of CM-field over an extension and over a basefield."
@@ -15,19 +22,21 @@ class ConductorTrait(Trait):
     }
     DEFAULT_PARAMS = {"deg": [2, 3, 4]}
 
+    def factorization_inputs(self, curve, params):
+        from dissect.utils.algebraic_factors import conductor_ratio_parts
+
+        return conductor_ratio_parts(curve, params["deg"])
+
     def compute(self, curve, params):
         """returns the factorization of the D_deg/D_1, where D_deg is the discriminant over the deg-th relative
         extension"""
-        from sage.all import ZZ, sqrt
-        from dissect.utils.utils import Factorization
+        from dissect.utils.algebraic_factors import conductor_ratio_parts, factor_parts
 
         curve_results = {}
-        disc_base = curve.extended_frobenius_disc()
-        disc_ext = curve.extended_frobenius_disc(params["deg"])
-        ratio_sqrt = ZZ(sqrt(disc_ext / disc_base))
+        ratio_sqrt = conductor_ratio_sqrt(curve, params["deg"])
         curve_results["ratio_sqrt"] = ratio_sqrt
-        curve_results["factorization"] = Factorization(
-            ratio_sqrt, timeout_duration=TRAIT_TIMEOUT
+        curve_results["factorization"] = factor_parts(
+            conductor_ratio_parts(curve, params["deg"]), TRAIT_TIMEOUT
         ).factorization()
         return curve_results
 
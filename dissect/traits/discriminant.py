@@ -13,6 +13,9 @@ class DiscriminantTrait(Trait):
     }
     DEFAULT_PARAMS = {}
 
+    def factorization_inputs(self, curve, params):
+        return [curve.extended_frobenius_disc()]
+
     def compute(self, curve, params):
         """
         Computation of d_K (cm_disc), v (max_conductor) and factorization of D where D=t^2-4q = v^2*d_K
@@ -12,11 +12,8 @@ class IsogenyNeighborsTrait(Trait):
         """
         Computes number of j-invariants j2 such that Phi_l(j,j2) where Phi_l is the l-modular polynomial.
         """
-        from sage.all import PolynomialRing
-        from dissect.utils.kohel.modular_polynomials import modular_polynomials
-
-        Phi = modular_polynomials(params["l"])
-        x = PolynomialRing(curve.field(), "x").gen()
+        Phi = curve.context().modular_polynomial(params["l"])
+        x = curve.context().polynomial_ring("x").gen()
         j = curve.j_invariant()
         f = Phi(j, x)
         return {"len": sum([i[1] for i in f.roots()])}
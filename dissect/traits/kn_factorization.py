@@ -6,7 +6,7 @@ TRAIT_TIMEOUT = 30
 
 
 def near_order_factorizations(n, sign="+", k=10, t=10):
-    """Computer factorization of k*n+1 (k*n-1) if 'sign' is "+" ("-") in time 't'"""
+    """Computes Factorization of k*n+1 (k*n-1) if 'sign' is "+" ("-") in time 't'"""
     from dissect.utils.utils import Factorization
 
     assert sign in ["+", "-"]
@@ -15,7 +15,7 @@ def near_order_factorizations(n, sign="+", k=10, t=10):
         m = k * n + 1
     else:
         m = k * n - 1
-    return Factorization(m, timeout_duration=t).factorization()
+    return Factorization(m, timeout_duration=t)
 
 
 def largest_factor_bitlen(factorization):
@@ -26,6 +26,19 @@ def largest_factor_bitlen(factorization):
         return factorization[-1].nbits()
 
 
+def largest_factor_bitlen_bound(f):
+    """Lower bound on the bit length of the largest prime factor, exact if the factorization did not time out"""
+    from dissect.utils.utils import TRIAL_BOUND
+
+    if not f.timeout():
+        return largest_factor_bitlen(f.factorization())
+    # The parts left unfactored have no prime factors up to the trial division bound
+    return max(
+        [p.nbits() for p in f.partial_factorization()]
+        + [TRIAL_BOUND.bit_length() for _ in f.cofactors()]
+    )
+
+
 class KNFactorizationTrait(Trait):
     NAME = "kn_factorization"
     DESCRIPTION = (
@@ -35,11 +48,17 @@ class KNFactorizationTrait(Trait):
     OUTPUT = {
         "(+)factorization": (List[int], "Factorization of $kn + 1$"),
         "(+)largest_factor_bitlen": (int, "Largest factor of $kn + 1$"),
+        "(+)largest_factor_bitlen_bound": (int, "Lower bound on the bit length of the largest prime factor of $kn + 1$"),
         "(-)factorization": (List[int], "Factorization of $kn - 1$"),
         "(-)largest_factor_bitlen": (int, "Largest factor of $kn - 1$"),
+        "(-)largest_factor_bitlen_bound": (int, "Lower bound on the bit length of the largest prime factor of $kn - 1$"),
     }
     DEFAULT_PARAMS = {"k": [1, 2, 3, 4, 5, 6, 7, 8]}
 
+    def factorization_inputs(self, curve, params):
+        card = curve.cardinality()
+        return [params["k"] * card + 1, params["k"] * card - 1]
+
     def compute(self, curve, params):
         """
         Computes factorization of ord*k+1 and ord*k-1 and bit lengths of their largest factors
@@ -48,18 +67,14 @@ class KNFactorizationTrait(Trait):
 
         card = curve.cardinality()
         t = TRAIT_TIMEOUT
-        curve_results = {
-            "(+)factorization": near_order_factorizations(card, "+", params["k"], t)
-        }
-        curve_results["(+)largest_factor_bitlen"] = largest_factor_bitlen(
-            curve_results["(+)factorization"]
-        )
-        curve_results["(-)factorization"] = near_order_factorizations(
-            card, "-", params["k"], t
-        )
-        curve_results["(-)largest_factor_bitlen"] = largest_factor_bitlen(
-            curve_results["(-)factorization"]
-        )
+        curve_results = {}
+        for sign in ("+", "-"):
+            f = near_order_factorizations(card, sign, params["k"], t)
+            curve_results[f"({sign})factorization"] = f.factorization()
+            curve_results[f"({sign})largest_factor_bitlen"] = largest_factor_bitlen(
+                f.factorization()
+            )
+            curve_results[f"({sign})largest_factor_bitlen_bound"] = largest_factor_bitlen_bound(f)
         return curve_results
 
 
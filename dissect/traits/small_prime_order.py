@@ -3,6 +3,21 @@ from dissect.traits import Trait
 TIMEOUT_DURATION = 30
 
 
+# Module-level functions, unlike lambdas, can be sent to the helper process of utils.timeout
+def multiplicative_order(x):
+    return x.multiplicative_order()
+
+
+def euler_phi(factorization):
+    """Euler's totient of a factored integer, None if the factorization timed out"""
+    if factorization.timeout():
+        return None
+    phi = 1
+    for p, e in factorization.factorization(False):
+        phi *= p ** (e - 1) * (p - 1)
+    return phi
+
+
 class SmallPrimeOrderTrait(Trait):
     NAME = "small_prime_order"
     DESCRIPTION = (
@@ -15,27 +30,29 @@ class SmallPrimeOrderTrait(Trait):
     }
     DEFAULT_PARAMS = {"l": [2, 3, 5, 7, 11, 13]}
 
+    def factorization_inputs(self, curve, params):
+        return [curve.order(), curve.cofactor()]
+
     def compute(self, curve, params):
         """
         Computes the multiplicative order of l (small prime) modulo curve cardinality and bit length of the index of the
         multiplicative subgroup generated by l Returns a dictionary
         """
-        from sage.all import Integers, ZZ, euler_phi
-        from dissect.utils.utils import timeout
+        from sage.all import Integers, ZZ
+        from dissect.utils.utils import Factorization, timeout
 
         card = curve.cardinality()
         try:
             assert card.gcd(params["l"]) == 1
             mul_ord = timeout(
-                lambda x: x.multiplicative_order(),
+                multiplicative_order,
                 [Integers(card)(params["l"])],
                 timeout_duration=TIMEOUT_DURATION,
             )
-            euler_phi_card = timeout(
-                lambda x: euler_phi(x[0]) * euler_phi(x[1]),
-                [(curve.order(), curve.cofactor())],
-                timeout_duration=TIMEOUT_DURATION * 0.5,
-            )
+            # The two factorizations split the time the totient had and go through the factorization cache
+            euler_phi_card = euler_phi(
+                Factorization(curve.order(), timeout_duration=TIMEOUT_DURATION * 0.25)
+            ) * euler_phi(Factorization(curve.cofactor(), timeout_duration=TIMEOUT_DURATION * 0.25))
             complement_bit_length = ZZ(euler_phi_card / mul_ord).nbits()
         except (TypeError, AssertionError):
             mul_ord = None
@@ -15,12 +15,16 @@ class TraceFactorizationTrait(Trait):
     }
     DEFAULT_PARAMS = {"deg": [1, 2]}
 
+    def factorization_inputs(self, curve, params):
+        from dissect.utils.algebraic_factors import trace_parts
+
+        return trace_parts(curve, params["deg"])
+
     def compute(self, curve, params):
         """Computation of the trace in an extension together with its factorization"""
-        from dissect.utils.utils import Factorization
+        from dissect.utils.algebraic_factors import factor_parts, trace_parts
 
-        trace = curve.extended_trace(params["deg"])
-        f = Factorization(trace, timeout_duration=TRAIT_TIMEOUT)
+        f = factor_parts(trace_parts(curve, params["deg"]), TRAIT_TIMEOUT)
         num_of_factors = (
             f.timeout_message() if f.timeout() else len(list(set(f.factorization())))
         )
@@ -17,6 +17,10 @@ class Trait:
     def compute(self, curve, params):
         raise NotImplementedError("Compute method for trait not implemented")
 
+    def factorization_inputs(self, curve, params):
+        """Integers the trait factors when computed on the curve, so that they can be prefactored in bulk"""
+        return []
+
     def params(self):
         return dict(self.DEFAULT_PARAMS)
 
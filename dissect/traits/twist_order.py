@@ -14,14 +14,19 @@ class TwistOrderTrait(Trait):
     }
     DEFAULT_PARAMS = {"deg": [1, 2]}
 
+    def factorization_inputs(self, curve, params):
+        from dissect.utils.algebraic_factors import twist_cardinality_parts
+
+        return twist_cardinality_parts(curve, params["deg"])
+
     def compute(self, curve, params):
         """Returns the factorization of the cardinality of the quadratic twist of the curve"""
-        from dissect.utils.utils import Factorization
+        from dissect.utils.algebraic_factors import factor_parts, twist_cardinality_parts
 
         tr = curve.extended_trace(params["deg"])
         card = curve.extended_cardinality(params["deg"])
         twist_card = card + 2 * tr
-        f = Factorization(twist_card, timeout_duration=TRAIT_TIMEOUT)
+        f = factor_parts(twist_cardinality_parts(curve, params["deg"]), TRAIT_TIMEOUT)
 
         curve_results = {
             "twist_cardinality": twist_card,
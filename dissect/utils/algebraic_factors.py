@@ -0,0 +1,150 @@
+from functools import reduce
+
+from sage.all import ZZ, divisors
+
+from dissect.utils.utils import Factorization
+
+# Cardinalities, traces and conductor ratios over extensions are values of the roots a, b of the Frobenius
+# polynomial x^2 - t*x + q, and split along the cyclotomic factors of x^n - 1 into parts that are factored (and
+# cached) separately. E.g. the conductor ratio over the 4th extension is (a^4 - b^4)/(a - b) = t * (t^2 - 2q),
+# with t shared with the conductor ratio over the 2nd extension and the trace over the base field.
+
+
+def lucas_sequences(trace, q, n):
+    """Returns U_0..U_n and V_0..V_n with U_k = (a^k - b^k)/(a - b) and V_k = a^k + b^k"""
+    u, v = [0, 1], [2, trace]
+    for _ in range(2, n + 1):
+        u.append(trace * u[-1] - q * u[-2])
+        v.append(trace * v[-1] - q * v[-2])
+    return u[: n + 1], v[: n + 1]
+
+
+def primitive_parts(values, n):
+    """Given values[d] for all d dividing n, which are products of parts[e] over all e dividing d, returns the
+    parts, or None if some value is zero"""
+    parts = {}
+    for d in divisors(n):
+        if values[d] == 0:
+            return None
+        parts[d] = values[d] // reduce(lambda x, e: x * parts[e], divisors(d)[:-1], 1)
+    return parts
+
+
+def cardinality_parts(curve, deg):
+    """Parts of the cardinalities of the curve over the extensions of degrees dividing deg, by divisor"""
+    _, v = lucas_sequences(curve.trace(), curve.q(), deg)
+    return primitive_parts({d: curve.q() ** d + 1 - v[d] for d in divisors(deg)}, deg)
+
+
+def twist_cardinality_parts(curve, deg):
+    """Parts of the cardinality of the quadratic twist over the deg-th extension, #E'(F_q^deg) = #E(F_q^2deg) /
+    #E(F_q^deg), i.e. the parts of the cardinality over the 2deg-th extension not dividing deg. There is a single
+    part for deg 1 and 2, the cardinality splits from deg 3 on"""
+    parts = cardinality_parts(curve, 2 * deg)
+    return [parts[d] for d in divisors(2 * deg) if deg % d != 0]
+
+
+def trace_parts(curve, deg):
+    """Parts of the trace over the deg-th extension, V_deg = U_2deg / U_deg"""
+    u, v = lucas_sequences(curve.trace(), curve.q(), 2 * deg)
+    parts = primitive_parts({d: u[d] for d in divisors(2 * deg)}, 2 * deg)
+    if parts is None:
+        return [v[deg]]
+    return [parts[d] for d in divisors(2 * deg) if deg % d != 0]
+
+
+def conductor_ratio_parts(curve, deg):
+    """Parts of the square root of the ratio of Frobenius discriminants over the deg-th extension and the base
+    field, |U_deg| (up to sign, the parts of U_deg other than U_1 = 1)"""
+    u, _ = lucas_sequences(curve.trace(), curve.q(), deg)
+    parts = primitive_parts({d: u[d] for d in divisors(deg)}, deg)
+    if parts is None:
+        return [abs(u[deg])]
+    return [abs(parts[d]) for d in divisors(deg) if d > 1] or [ZZ(1)]
+
+
+def factor_parts(parts, timeout_duration):
+    """Factorization of the product of the parts, each part factored separately within timeout_duration"""
+    return reduce(
+        lambda f, g: f + g,
+        (Factorization(part, timeout_duration=timeout_duration) for part in parts),
+    )
+
+
+def _product(parts):
+    return reduce(lambda x, y: x * y, parts, 1)
+
+
+def test_lucas_sequences():
+    u, v = lucas_sequences(3, 7, 4)
+    assert u == [0, 1, 3, 2, -15]
+    assert v == [2, 3, -5, -36, -73]
+    u, v = lucas_sequences(5, 11, 12)
+    assert all(u[2 * k] == u[k] * v[k] for k in range(7))
+
+
+def test_primitive_parts():
+    # The parts of 2^d - 1 are the values of the cyclotomic polynomials at 2
+    parts = primitive_parts({d: 2**d - 1 for d in divisors(12)}, 12)
+    assert parts == {1: 1, 2: 3, 3: 7, 4: 5, 6: 3, 12: 13}
+    assert primitive_parts({1: 1, 2: 0}, 2) is None
+
+
+def test_cardinality_parts():
+    from dissect.utils.extension_tower import _Curve
+
+    curve = _Curve(3, 7)
+    _, v = lucas_sequences(3, 7, 6)
+    parts = cardinality_parts(curve, 6)
+    assert parts[1] == 7 + 1 - 3
+    assert _product(parts.values()) == 7**6 + 1 - v[6]
+    assert _product(twist_cardinality_parts(curve, 3)) == 7**3 + 1 + v[3]
+    assert len(twist_cardinality_parts(curve, 2)) == 1
+    assert len(twist_cardinality_parts(curve, 3)) == 2
+
+
+def test_trace_parts():
+    from dissect.utils.extension_tower import _Curve
+
+    curve = _Curve(3, 7)
+    _, v = lucas_sequences(3, 7, 6)
+    assert _product(trace_parts(curve, 6)) == v[6]
+    assert trace_parts(_Curve(0, 7), 1) == [0]
+
+
+def test_conductor_ratio_parts():
+    from dissect.utils.extension_tower import _Curve
+
+    curve = _Curve(3, 7)
+    u, _ = lucas_sequences(3, 7, 6)
+    assert abs(_product(conductor_ratio_parts(curve, 6))) == abs(u[6])
+    assert conductor_ratio_parts(curve, 1) == [1]
+    # Prefactoring takes the bit lengths of the parts
+    assert conductor_ratio_parts(curve, 1)[0].nbits() == 1
+    # U_3 = t^2 - q vanishes for t^2 = q
+    assert conductor_ratio_parts(_Curve(3, 9), 3) == [0]
+
+
+def test_factor_parts(monkeypatch):
+    import dissect.utils.algebraic_factors as module
+    from dissect.utils.telemetry import TIMEOUT_MESSAGE
+
+    # Parts with known factorizations instead of factoring them
+    known = Factorization
+
+    def factorization(part, timeout_duration):
+        if part == 6:
+            return known(6, factorization=[(2, 1), (3, 1)])
+        left = known(part, factorization=TIMEOUT_MESSAGE)
+        left._partial, left._composites = [(3, 1)], [part // 3]
+        left._effort = {"seconds": 1.0, "rho": True, "ecm": 2}
+        return left
+
+    monkeypatch.setattr(module, "Factorization", factorization)
+    product = factor_parts([6], 1)
+    assert product.factorization(False) == [(2, 1), (3, 1)]
+    product = factor_parts([6, 3 * 10403], 1)
+    assert product.timeout()
+    assert product.partial_factorization(False) == [(2, 1), (3, 2)]
+    assert product.cofactors() == [10403]
+    assert product.effort() == {"seconds": 1.0, "rho": True, "ecm": 2}
@@ -0,0 +1,117 @@
+from sage.all import ZZ, factor, gcd, prime_range, prod
+
+from dissect.utils.factor_cache import FACTOR_CACHE
+
+SMOOTH_BOUND = 2**20
+
+# All products and remainders are computed on Sage integers: GMP multiplies and divides the large numbers near
+# the root of the trees in quasi-linear time, Python integers take quadratic time. Only the factorization cache
+# converts to Python integers.
+
+
+def product_tree(values):
+    """Levels of pairwise products, from the values up to their product"""
+    tree = [[ZZ(x) for x in values]]
+    while len(tree[-1]) > 1:
+        level = tree[-1]
+        tree.append([prod(level[i : i + 2]) for i in range(0, len(level), 2)])
+    return tree
+
+
+def remainder_tree(n, tree, square=False):
+    """Remainders of n modulo each value (or its square) at the bottom of the product tree"""
+    remainders = [n]
+    for level in reversed(tree):
+        remainders = [
+            remainders[i // 2] % (x * x if square else x) for i, x in enumerate(level)
+        ]
+    return remainders
+
+
+def smooth_parts(values, bound=SMOOTH_BOUND):
+    """Largest divisors of the values with all prime factors below bound (Bernstein's batch algorithm)"""
+    tree = product_tree(values)
+    remainders = remainder_tree(prod(prime_range(bound)), tree)
+    parts = []
+    for x, z in zip(tree[0], remainders):
+        # z^(2^e) mod x contains every small prime with an exponent at least its exponent in x
+        for _ in range(ZZ(max(x.nbits() - 1, 0)).nbits()):
+            z = z * z % x
+        parts.append(gcd(x, z))
+    return parts
+
+
+def batch_gcd(values):
+    """gcd of each value with the product of all the others, without computing them one by one"""
+    tree = product_tree(values)
+    remainders = remainder_tree(tree[-1][0], tree, square=True)
+    return [gcd(x, r // x) for x, r in zip(tree[0], remainders)]
+
+
+def seed_factorizations(values, bound=SMOOTH_BOUND):
+    """Records the small factors and the factors shared across the values in the factorization cache, so that
+    only the remaining cofactors go through the staged factorization. Returns the numbers of values that
+    were factored completely and partially."""
+    values = sorted(set(abs(ZZ(x)) for x in values if abs(x) > 1 and FACTOR_CACHE.get(x) is None))
+    if not values:
+        return 0, 0
+    smooth = smooth_parts(values, bound)
+    rough = [x // s for x, s in zip(values, smooth)]
+    shared = batch_gcd(rough)
+
+    complete, partial = 0, 0
+    for x, s, r, g in zip(values, smooth, rough, shared):
+        primes = list(factor(s)) if s > 1 else []
+        # A value sharing all of its factors with others gives no split
+        pieces = [g, r // g] if 1 < g < r else [r]
+        composites = []
+        for piece in pieces:
+            if piece == 1:
+                continue
+            if piece.is_pseudoprime():
+                primes.append((piece, 1))
+            else:
+                composites.append(piece)
+        if not composites:
+            complete += 1
+        elif s > 1 or len(pieces) > 1:
+            partial += 1
+        else:
+            continue
+        FACTOR_CACHE.put(x, _merge(primes), composites, 0.0)
+    return complete, partial
+
+
+def _merge(factors):
+    merged = {}
+    for p, e in factors:
+        merged[p] = merged.get(p, 0) + e
+    return sorted(merged.items())
+
+
+def test_product_tree():
+    tree = product_tree([2, 3, 5, 7, 11])
+    assert tree == [[2, 3, 5, 7, 11], [6, 35, 11], [210, 11], [2310]]
+    assert product_tree([4]) == [[4]]
+
+
+def test_remainder_tree():
+    values = [2, 3, 5, 7, 11]
+    tree = product_tree(values)
+    assert remainder_tree(1000, tree) == [1000 % x for x in values]
+    assert remainder_tree(1000, tree, square=True) == [1000 % (x * x) for x in values]
+
+
+def test_smooth_parts():
+    # 101 and 103 are above the bound, the powers of small primes are kept whole
+    values = [2**5 * 3 * 101, 101 * 103, 7**3, 97 * 89]
+    assert smooth_parts(values, 100) == [96, 1, 343, 97 * 89]
+
+
+def test_batch_gcd():
+    values = [101 * 103, 103 * 107, 109 * 113, 101 * 127]
+    assert batch_gcd(values) == [101 * 103, 103, 1, 101]
+
+
+def test_merge():
+    assert _merge([(3, 1), (2, 1), (3, 2)]) == [(2, 1), (3, 3)]
@@ -0,0 +1,73 @@
+import argparse
+import json
+import os
+import socket
+import sys
+import tempfile
+
+# Deliberately free of Sage imports: the client starts in milliseconds and leaves the work to the daemon
+DEFAULT_SOCKET = os.path.join(tempfile.gettempdir(), f"dissect-{os.getuid()}.sock")
+
+
+def request(payload, socket_path=DEFAULT_SOCKET):
+    """Sends one request to the compute daemon and returns its response"""
+    with socket.socket(socket.AF_UNIX, socket.SOCK_STREAM) as connection:
+        connection.connect(socket_path)
+        connection.sendall(json.dumps(payload).encode() + b"\n")
+        with connection.makefile("rb") as f:
+            response = f.readline()
+    if not response:
+        raise ConnectionError("the compute daemon closed the connection")
+    return json.loads(response)
+
+
+def main():
+    parser = argparse.ArgumentParser(
+        description="DiSSECT trait computation client of dissect-compute-daemon."
+    )
+    parser.add_argument("-t", "--trait", type=str, help="Trait identifier", required=True)
+    parser.add_argument(
+        "-i",
+        "--input",
+        type=str,
+        help="Input curves file (stdin by default)",
+        default=None,
+    )
+    parser.add_argument(
+        "-o", "--output", type=str, help="Output file (stdout by default)", default=None
+    )
+    parser.add_argument(
+        "--socket",
+        default=DEFAULT_SOCKET,
+        help=f"Socket of the compute daemon (default: {DEFAULT_SOCKET})",
+    )
+
+    args = parser.parse_args()
+
+    if args.input:
+        with open(args.input, "r") as f:
+            curves = json.load(f)
+    else:
+        curves = json.load(sys.stdin)
+
+    if not isinstance(curves, list):
+        curves = curves["curves"]
+
+    try:
+        response = request({"trait": args.trait, "curves": curves}, args.socket)
+    except (ConnectionError, FileNotFoundError) as e:
+        print(f"Cannot reach the compute daemon at {args.socket}: {e}", file=sys.stderr)
+        sys.exit(1)
+    if "error" in response:
+        print(response["error"], file=sys.stderr)
+        sys.exit(1)
+
+    json.dump(
+        response,
+        sys.stdout if not args.output else open(args.output, "w"),
+        indent=2,
+    )
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,111 @@
+import argparse
+import errno
+import json
+import os
+import signal
+import socket
+import socketserver
+import sys
+from multiprocessing import Pool
+
+from dissect.traits import TRAITS
+from dissect.utils.compute_client import DEFAULT_SOCKET
+from dissect.utils.compute_db import tprint
+from dissect.utils.compute_json import compute_curve
+
+MAX_TASKS_PER_CHILD = 1000
+
+
+def handle_request(pool, request):
+    """Computes a {"trait", "curves", ["params"]} request on the pool, curves in parallel"""
+    trait = request.get("trait")
+    if trait not in TRAITS:
+        return {"error": f"Trait {trait} is not implemented"}
+    curves = request.get("curves")
+    if not isinstance(curves, list):
+        return {"error": "Request has no list of curves"}
+    params_list = request.get("params") or list(TRAITS[trait].params_iter())
+
+    pending = [
+        pool.apply_async(compute_curve, (curve, trait, params_list)) for curve in curves
+    ]
+    results = {"data": []}
+    for result in pending:
+        results["data"].extend(result.get())
+    return results
+
+
+class RequestHandler(socketserver.StreamRequestHandler):
+    def handle(self):
+        # One JSON request per line, answered by one JSON line
+        for line in self.rfile:
+            try:
+                response = handle_request(self.server.pool, json.loads(line))
+            except Exception as e:
+                response = {"error": f"{type(e).__name__}: {e}"}
+            self.wfile.write(json.dumps(response).encode() + b"\n")
+            self.wfile.flush()
+
+
+class ComputeServer(socketserver.ThreadingMixIn, socketserver.UnixStreamServer):
+    """Serves trait computations on a pool of workers forked after Sage was loaded"""
+
+    daemon_threads = True
+
+    def __init__(self, socket_path, pool):
+        self.pool = pool
+        if os.path.exists(socket_path):
+            # Only the socket of a daemon that is gone is replaced
+            probe = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+            try:
+                probe.connect(socket_path)
+            except (ConnectionRefusedError, FileNotFoundError):
+                os.unlink(socket_path)
+            else:
+                raise OSError(errno.EADDRINUSE, f"A daemon is already listening on {socket_path}")
+            finally:
+                probe.close()
+        super().__init__(socket_path, RequestHandler)
+        os.chmod(socket_path, 0o600)
+
+
+def main():
+    parser = argparse.ArgumentParser(
+        description="DiSSECT compute daemon keeping Sage loaded for dissect-compute-client."
+    )
+    parser.add_argument(
+        "--socket",
+        default=DEFAULT_SOCKET,
+        help=f"Socket to listen on (default: {DEFAULT_SOCKET})",
+    )
+    parser.add_argument(
+        "-j",
+        "--jobs",
+        type=int,
+        default=os.cpu_count(),
+        help="Number of warm worker processes (default: number of CPUs)",
+    )
+    args = parser.parse_args()
+
+    # Workers are forked from this process, which already imported Sage and constructed the traits
+    pool = Pool(args.jobs, maxtasksperchild=MAX_TASKS_PER_CHILD)
+    try:
+        server = ComputeServer(args.socket, pool)
+    except OSError as e:
+        pool.terminate()
+        parser.exit(1, f"{e.strerror}\n")
+    signal.signal(signal.SIGTERM, lambda *_: sys.exit(0))
+    tprint(f"Listening on {args.socket} with {args.jobs} workers")
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        server.server_close()
+        os.unlink(args.socket)
+        pool.terminate()
+        tprint("Daemon stopped")
+
+
+if __name__ == "__main__":
+    main()
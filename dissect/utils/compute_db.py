@@ -1,56 +1,290 @@
 import argparse
-import itertools
 import datetime
-from math import prod
+import itertools
+import os
+import socket
+import sys
+import threading
+import time
 from multiprocessing import Process, Queue, Lock
+from queue import Empty
 
 from pymongo.errors import ServerSelectionTimeoutError
 
 from dissect.utils.database_handler import (
     connect,
-    store_trait_result,
-    is_solved,
+    get_unsolved,
     get_curves,
-    get_curves_count,
-    get_trait_results_count,
+    get_coverage,
+    _params_key,
     create_trait_index,
+    create_telemetry_index,
+    create_run,
+    get_run,
+    get_jobs,
+    store_run_progress,
+    claim_jobs,
+    extend_leases,
+    complete_jobs,
+    release_job,
+    create_requests,
+    claim_request,
+    complete_requests,
+    release_request,
+    get_run_progress,
+    get_timed_out,
 )
 from dissect.traits import TRAITS
-from dissect.utils.custom_curve import CustomCurve
+from dissect.utils.cost_model import CostModel, makespan_bound
+from dissect.utils.memory_budget import CoreBudget, MemoryBudget
+from dissect.utils.metrics import Metrics
+from dissect.utils.batch_factor import seed_factorizations
+from dissect.utils.custom_curve import CurveCache
+from dissect.utils.factor_cache import DISK_MIN_BITS, FACTOR_CACHE
+from dissect.utils.field_context import field_key
+from dissect.utils.result_writer import ResultWriter
+from dissect.utils.supervisor import HARD_TIMEOUT, RECYCLE_EXIT_CODE, Supervisor, own_process_group
+from dissect.utils.telemetry import current_rss, measure
+from dissect.utils.timeout_pool import available_cores
+from dissect.utils.utils import TIMEOUT_TIERS, set_core_budget, set_portfolio, set_timeout_tier
+
+
+CURVE_BATCH_SIZE = 1000
+# Jobs ordered at once when planning a run, the order is longest expected first within each chunk
+PLAN_CHUNK_SIZE = 100000
+CURVE_CACHE_SIZE = 64
+CHECKPOINT_INTERVAL = 30
+QUERY_KEYS = ("category", "bits", "cofactor")
+CLAIM_BATCH_SIZE = 4
+LEASE_DURATION = 300
+POLL_INTERVAL = 10
+PRIORITY_POLL_INTERVAL = 1
+# The interval between polls of the priority lane doubles up to this while the lane stays empty
+PRIORITY_POLL_MAX_INTERVAL = 16
+MAX_DEFERRED_JOBS = 8
+LOW_PRIORITY_NICENESS = 10
+MAX_ATTEMPTS = 2
 
 
 def tprint(string):
     print(f"[{datetime.datetime.now()}] {string}")
 
 
-def producer(database, trait, args, queue, lock):
+def plan_run(database, traits, args, lock):
     db = connect(database)
-    create_trait_index(db, trait)
+    for trait in traits:
+        create_trait_index(db, trait)
+    create_telemetry_index(db)
 
     with lock:
         tprint("Preliminary check")
 
-    total = get_curves_count(db, query=vars(args)) * prod(
-        map(len, TRAITS[trait].params().values())
+    cost_model = CostModel().load(db, traits)
+    rows = coverage(db, traits, args, cost_model)
+    for trait in traits:
+        trait_rows = [row for row in rows if row["trait"] == trait]
+        total = sum(row["curves"] for row in trait_rows)
+        computed = total - sum(row["missing"] for row in trait_rows)
+        with lock:
+            print(f"{trait}: computed {computed}/{total}")
+
+    with lock:
+        tprint("Planning unsolved work")
+
+    unsolved = (
+        (
+            tasks,
+            db_curve["field"]["bits"],
+            (db_curve["name"], db_curve["field"]["bits"], tasks, field_key(db_curve["field"])),
+        )
+        for db_curve, tasks in get_unsolved(db, traits, query=vars(args))
+    )
+    totals = {"count": 0, "cost": 0.0, "largest": 0.0}
+
+    def jobs():
+        for cost, (name, bits, tasks, _) in plan_chunks(cost_model, unsolved, args.group_by_field):
+            totals["count"] += 1
+            totals["cost"] += cost
+            totals["largest"] = max(totals["largest"], cost)
+            yield {
+                "curve": name,
+                "tasks": [{"trait": t, "params": p} for t, p in tasks],
+                "cost": cost,
+                "memory": cost_model.footprint(tasks, bits),
+            }
+
+    query = {key: getattr(args, key) for key in QUERY_KEYS}
+    run_id = create_run(db, traits, query, jobs())
+
+    with lock:
+        tprint(
+            f"Planned run {run_id} with {totals['count']} curves, estimated {totals['cost']:.0f} core-seconds,"
+            f" makespan at least {makespan_bound(totals['cost'], totals['largest'], args.jobs):.0f} s"
+        )
+    return get_run(db, run_id)
+
+
+def plan_chunks(cost_model, jobs, group=False, chunk_size=PLAN_CHUNK_SIZE):
+    """Yields (cost, item) pairs of ([(trait, params), ...], bits, item) jobs longest expected first within
+    consecutive chunks of chunk_size jobs (grouped by field within a chunk if group is set), so that planning
+    holds a single chunk in memory however large the run is"""
+    jobs = iter(jobs)
+    while True:
+        plan = cost_model.order(itertools.islice(jobs, chunk_size))
+        if not plan:
+            return
+        if group:
+            plan = group_by_field(plan)
+        yield from plan
+
+
+def group_by_field(plan):
+    """Orders (cost, item) pairs with the field key last in the item by field, the fields with the most work
+    first, keeping the order within a field, so that consecutive jobs reuse the field contexts of the workers"""
+    totals, first = {}, {}
+    for index, (cost, item) in enumerate(plan):
+        totals[item[-1]] = totals.get(item[-1], 0) + cost
+        first.setdefault(item[-1], index)
+    return sorted(plan, key=lambda x: (-totals[x[1][-1]], first[x[1][-1]]))
+
+
+def coverage(db, traits, args, cost_model):
+    """Returns per trait, params, category and bit length the number of done, timed out, failed and missing
+    results together with the estimated core-hours to compute the missing ones"""
+    curves, results = get_coverage(db, traits, query=vars(args))
+    rows = []
+    for trait in traits:
+        for params in TRAITS[trait].params_iter():
+            key = _params_key(params)
+            for (category, bits), count in sorted(curves.items()):
+                row = {
+                    "trait": trait,
+                    "params": params,
+                    "category": category,
+                    "bits": bits,
+                    "curves": count,
+                }
+                for status in ("ok", "timeout", "failed"):
+                    row[status] = results.get((trait, key, category, bits, status), 0)
+                row["missing"] = max(count - row["ok"] - row["timeout"] - row["failed"], 0)
+                row["hours"] = row["missing"] * cost_model.estimate(trait, params, bits) / 3600
+                rows.append(row)
+    return rows
+
+
+def print_plan(database, traits, args):
+    """Prints the coverage of the selected traits and curves and the estimated cost without planning a run"""
+    db = connect(database)
+    rows = coverage(db, traits, args, CostModel().load(db, traits))
+    print(
+        f"{'trait':<22}{'params':<16}{'category':<16}{'bits':>6}{'curves':>9}"
+        f"{'done':>9}{'timeout':>9}{'failed':>9}{'missing':>9}{'core h':>10}"
+    )
+    for row in rows:
+        params = ",".join(f"{k}={v}" for k, v in row["params"].items())
+        print(
+            f"{row['trait']:<22}{params:<16}{row['category']:<16}{row['bits']:>6}{row['curves']:>9}"
+            f"{row['ok']:>9}{row['timeout']:>9}{row['failed']:>9}{row['missing']:>9}{row['hours']:>10.2f}"
+        )
+    hours = sum(row["hours"] for row in rows)
+    print(
+        f"Missing {sum(row['missing'] for row in rows)} results, estimated {hours:.2f} core-hours"
+        f" ({hours / args.jobs:.2f} h on {args.jobs} jobs)"
+    )
+
+
+def submit(database, traits, names, priority, lock):
+    """Queues the unsolved tasks of the given curves as requests, claimed before any job of a run"""
+    db = connect(database)
+    for trait in traits:
+        create_trait_index(db, trait)
+
+    # One request per curve and trait, so that a curve profile is spread over the idle workers
+    cost_model = CostModel().load(db, traits)
+    requests = []
+    for db_curve, tasks in get_unsolved(db, traits, query={"name": names}):
+        for trait, group in itertools.groupby(tasks, key=lambda task: task[0]):
+            group = list(group)
+            requests.append(
+                {
+                    "curve": db_curve["name"],
+                    "tasks": [{"trait": t, "params": p} for t, p in group],
+                    "cost": sum(cost_model.estimate(t, p, db_curve["field"]["bits"]) for t, p in group),
+                    "memory": cost_model.footprint(group, db_curve["field"]["bits"]),
+                }
+            )
+    request_ids = create_requests(db, requests, priority)
+
+    with lock:
+        tprint(f"Submitted {len(request_ids)} requests with priority {priority}")
+    return request_ids
+
+
+def plan_retry(database, traits, args, lock):
+    db = connect(database)
+    for trait in traits:
+        create_trait_index(db, trait)
+
+    with lock:
+        tprint("Planning retries of timed out results")
+
+    # Group timed out tasks by curve and the next budget tier
+    groups = {}
+    for curve, trait, params, tier in get_timed_out(
+        db, traits, query=vars(args), max_tier=len(TIMEOUT_TIERS) - 2
+    ):
+        group = groups.setdefault(
+            (curve["name"], tier + 1), {"bits": curve["bits"], "tasks": []}
+        )
+        group["tasks"].append((trait, params))
+
+    # Cheapest first, so that the easier instances finish before the budget is spent on the hard ones
+    cost_model = CostModel().load(db, traits)
+    plan = cost_model.order(
+        (group["tasks"], group["bits"], key) for key, group in groups.items()
+    )
+    plan.sort(key=lambda x: (x[1][1], x[0]))
+
+    query = {key: getattr(args, key) for key in QUERY_KEYS}
+    run_id = create_run(
+        db,
+        traits,
+        query,
+        (
+            {
+                "curve": name,
+                "tasks": [{"trait": t, "params": p} for t, p in groups[(name, tier)]["tasks"]],
+                "cost": cost * TIMEOUT_TIERS[tier],
+                "memory": cost_model.footprint(groups[(name, tier)]["tasks"], groups[(name, tier)]["bits"]),
+                "tier": tier,
+            }
+            for cost, (name, tier) in plan
+        ),
+        retry=True,
     )
-    computed = get_trait_results_count(db, trait, query=vars(args))
 
     with lock:
-        print(f"Computed {computed}/{total}")
-        tprint("Producer start")
+        tprint(f"Planned retry run {run_id} with {len(plan)} curves")
+    return get_run(db, run_id)
+
 
-    curves = map(CustomCurve, get_curves(db, query=vars(args)))
-    counter = 0
-    iterator = itertools.product(curves, TRAITS[trait].params_iter())
-    while counter <= args.skip:
-        next(iterator)
-        counter += 1
+def producer(database, run, args, queue, lock):
+    db = connect(database)
+
+    with lock:
+        tprint(f"Producer start at job {run['watermark']}/{run['jobs']}")
 
-    for curve, params in iterator:
-        queue.put((curve, params), block=True)
-        if args.verbose:
-            print(f"{counter:>9} {curve.name()}:{params}")
-        counter += 1
+    pending = get_jobs(db, run)
+    for jobs in iter(lambda: list(itertools.islice(pending, CURVE_BATCH_SIZE)), []):
+        db_curves = {
+            db_curve["name"]: db_curve
+            for db_curve in get_curves(db, query={"name": [job["curve"] for job in jobs]})
+        }
+        # Curves are shipped as raw database records and constructed by consumers
+        for job in jobs:
+            queue.put((db_curves[job["curve"]], job), block=True)
+            if args.verbose:
+                print(f"{job['index']:>9} {job['curve']}:{job['tasks']}")
 
     for _ in range(args.jobs):
         queue.put((None, None))
@@ -59,45 +293,467 @@ def producer(database, trait, args, queue, lock):
         tprint("Producer finish")
 
 
-def consumer(identifier, database, trait, queue, lock):
+def prefactor(database, run, lock):
+    """Seeds the factorization cache with the small and shared factors of all integers the run will factor"""
     db = connect(database)
-    if trait not in TRAITS:
-        with lock:
-            tprint(f"Consumer {identifier:2d} could not be initialized")
-        return
 
     with lock:
-        tprint(f"Consumer {identifier:2d} started")
+        tprint("Collecting factorization inputs")
 
-    while True:
-        curve, params = queue.get()
-        if curve is params is None:
+    inputs = set()
+    curves = CurveCache(CURVE_CACHE_SIZE)
+    pending = get_jobs(db, run)
+    for jobs in iter(lambda: list(itertools.islice(pending, CURVE_BATCH_SIZE)), []):
+        db_curves = {
+            db_curve["name"]: db_curve
+            for db_curve in get_curves(db, query={"name": [job["curve"] for job in jobs]})
+        }
+        for job in jobs:
+            curve = curves.get(db_curves[job["curve"]])
+            for task in job["tasks"]:
+                inputs.update(
+                    x
+                    for x in TRAITS[task["trait"]].factorization_inputs(curve, task["params"])
+                    if abs(x).nbits() >= DISK_MIN_BITS
+                )
+
+    complete, partial = seed_factorizations(inputs)
+    with lock:
+        tprint(
+            f"Prefactored {len(inputs)} integers: {complete} completely, {partial} partially"
+        )
+
+
+def checkpointer(database, run, done, lock):
+    """Advances the committed progress watermark of the run from indices of stored jobs"""
+    db = connect(database)
+    watermark, completed = run["watermark"], set(run["done"])
+    last_checkpoint = time.monotonic()
+    finished = False
+    while not finished:
+        try:
+            indices = done.get(timeout=CHECKPOINT_INTERVAL)
+        except Empty:
+            indices = []
+        if indices is None:
+            finished = True
+            indices = []
+        if indices:
+            complete_jobs(db, run["_id"], indices)
+        completed.update(indices)
+        while watermark in completed:
+            completed.remove(watermark)
+            watermark += 1
+        if finished or time.monotonic() - last_checkpoint >= CHECKPOINT_INTERVAL:
+            store_run_progress(
+                db, run["_id"], watermark, completed, watermark >= run["jobs"]
+            )
+            last_checkpoint = time.monotonic()
+
+    with lock:
+        tprint(f"Run {run['_id']} checkpointed at job {watermark}/{run['jobs']}")
+
+
+def compute_job(identifier, curve, job, writer, lock, events=None, control=None):
+    tier = job.get("tier", 0)
+    set_timeout_tier(tier)
+    abandoned = {position: status for position, status in job.get("abandoned", [])}
+    # The job is complete once every result and telemetry record tagged with it is stored
+    tag = job_tag(job)
+    if events is not None:
+        events.put(("start", identifier))
+    # All traits share the curve object and the intermediate results memoized on it
+    for position, task in enumerate(job["tasks"]):
+        trait, params = task["trait"], task["params"]
+        if position in abandoned:
+            # The task repeatedly took its worker down, store its status instead of computing it again
+            trait_result, stats = {}, {"wall": 0.0, "status": abandoned[position], "abandoned": True}
+        else:
+            if control is not None:
+                control.put(("task", identifier, tag, position, tier))
+            trait_result, stats = measure(TRAITS[trait], curve, **params)
+        stats["tier"] = tier
+        if stats["status"] == "failed" and "error" in stats:
             with lock:
-                tprint(f"Consumer {identifier:2d} stopped")
-            return
+                tprint(
+                    f"Consumer {identifier:2d} failed on {curve.name()}:{trait}:{params}"
+                    f" ({stats['error']})"
+                )
+        if trait_result or position in abandoned:
+            writer.store(curve, trait, params, trait_result, stats["status"], tier, tag)
+        writer.store_telemetry(curve, trait, params, stats, tag)
+        if events is not None:
+            events.put(("task", identifier, trait, stats["status"], stats["wall"]))
+    writer.finish(tag)
+    if events is not None:
+        events.put(("finish", identifier))
+    if control is not None:
+        control.put(("idle", identifier))
+
+
+def job_tag(job):
+    """Jobs of runs are tagged by their index, requests by their identifier"""
+    return job["index"] if "index" in job else ("request", job["_id"])
+
+
+def split_tags(tags):
+    indices = [tag for tag in tags if not isinstance(tag, tuple)]
+    request_ids = [tag[1] for tag in tags if isinstance(tag, tuple)]
+    return indices, request_ids
+
+
+def claim_priority(db, owner):
+    """Claims the most urgent request, if any, as a (curve record, job) pair"""
+    request = claim_request(db, owner, LEASE_DURATION)
+    if request is None:
+        return None
+    db_curve = next(iter(get_curves(db, query={"name": request["curve"]})), None)
+    if db_curve is None:
+        complete_requests(db, [request["_id"]])
+        return None
+    return db_curve, request
+
+
+class PriorityLane:
+    """Claims requests for one worker, polling the database less often while no request is waiting"""
+
+    def __init__(self, db, owner):
+        self._db = db
+        self._owner = owner
+        self._interval = PRIORITY_POLL_INTERVAL
+        self._due = 0.0
+
+    def claim(self):
+        if time.monotonic() < self._due:
+            return None
+        item = claim_priority(self._db, self._owner)
+        if item is None:
+            self._due = time.monotonic() + self._interval
+            self._interval = min(2 * self._interval, PRIORITY_POLL_MAX_INTERVAL)
+        else:
+            self._interval, self._due = PRIORITY_POLL_INTERVAL, 0.0
+        return item
+
+
+def on_write(identifier, events):
+    if events is None:
+        return None
+    return lambda seconds: events.put(("write", identifier, seconds))
+
+
+def exhausted(computed, max_tasks, max_rss):
+    """Whether a worker should be replaced by a fresh process to release the memory accumulated by Sage"""
+    if max_tasks and computed >= max_tasks:
+        return True
+    return bool(max_rss and current_rss() > max_rss)
+
+
+def abandon_task(job, position, status):
+    """Marks the task a lost job was computing to be skipped once the job was lost MAX_ATTEMPTS times"""
+    if position is not None and job.get("attempts", 1) >= MAX_ATTEMPTS:
+        job["abandoned"] = job.get("abandoned", []) + [[position, status]]
+
+
+def taken(control, identifier, item):
+    """Reports a (curve record, job) item taken off the queue or claimed, deferred or not, so that the supervisor
+    requeues it if this consumer is lost before its results are stored"""
+    if control is not None:
+        _, job = item
+        control.put(("job", identifier, job_tag(job), item, job.get("requeued", False)))
+
+
+def reserve(budget, identifier, item, deferred):
+    """Reserves memory for the (curve record, job) item, or defers it when it does not fit now"""
+    if budget is None or budget.acquire(identifier, item[1].get("memory", 0), block=False):
+        return True
+    deferred.append(item)
+    return False
+
+
+def reserve_deferred(budget, identifier, deferred, block):
+    """Takes the first deferred job that fits into the memory budget, or waits for the oldest one if block"""
+    for i, (_, job) in enumerate(deferred):
+        if budget.acquire(identifier, job.get("memory", 0), block=False):
+            return deferred.pop(i)
+    if not block:
+        return None
+    budget.acquire(identifier, deferred[0][1].get("memory", 0))
+    return deferred.pop(0)
+
+
+def consumer(
+    identifier,
+    database,
+    queue,
+    done,
+    lock,
+    low_priority=False,
+    events=None,
+    control=None,
+    max_tasks=None,
+    max_rss=None,
+    budget=None,
+    cores=None,
+):
+    own_process_group()
+    if low_priority:
+        os.nice(LOW_PRIORITY_NICENESS)
+    set_core_budget(cores, identifier)
+
+    with lock:
+        tprint(f"Consumer {identifier:2d} started")
+
+    db = connect(database)
+    owner = f"{socket.gethostname()}:{os.getpid()}"
+    stop = threading.Event()
+    threading.Thread(target=heartbeat, args=(database, owner, stop), daemon=True).start()
+
+    def on_flush(tags):
+        indices, request_ids = split_tags(tags)
+        if request_ids:
+            complete_requests(db, request_ids)
+        if indices:
+            done.put(indices)
+        if control is not None:
+            control.put(("committed", identifier, tags))
+
+    def on_fail(tags):
+        # Jobs of the run are requeued by the supervisor once this consumer exits
+        for request_id in split_tags(tags)[1]:
+            release_request(db, request_id, owner=owner)
+
+    curves = CurveCache(CURVE_CACHE_SIZE)
+    computed, recycle = 0, False
+    lane = PriorityLane(db, owner)
+    deferred, stopping = [], False
+    with ResultWriter(
+        database,
+        on_flush=on_flush,
+        on_write=on_write(identifier, events),
+        on_fail=on_fail,
+    ) as writer:
+        while not (recycle or stopping and not deferred):
+            item = None
+            if deferred:
+                item = reserve_deferred(
+                    budget, identifier, deferred, stopping or len(deferred) >= MAX_DEFERRED_JOBS
+                )
+            # Requests jump ahead of the jobs already waiting in the queue
+            if item is None:
+                item = lane.claim()
+                if item is not None:
+                    taken(control, identifier, item)
+                    if not reserve(budget, identifier, item, deferred):
+                        continue
+            if item is None:
+                try:
+                    item = queue.get(timeout=PRIORITY_POLL_INTERVAL)
+                except Empty:
+                    continue
+                if item[0] is item[1] is None:
+                    stopping = True
+                    if control is not None:
+                        # A replacement of this consumer needs a sentinel of its own
+                        control.put(("stopping", identifier))
+                    continue
+                taken(control, identifier, item)
+                if not reserve(budget, identifier, item, deferred):
+                    continue
+            db_curve, job = item
+            compute_job(identifier, curves.get(db_curve), job, writer, lock, events, control)
+            if budget is not None:
+                budget.release(identifier)
+            computed += len(job["tasks"])
+            # Deferred jobs would be requeued if this consumer left, it computes them first, and once it took its
+            # sentinel it finishes instead of leaving the queue to a replacement
+            recycle = not deferred and not stopping and exhausted(computed, max_tasks, max_rss)
+    stop.set()
+
+    with lock:
+        tprint(f"Consumer {identifier:2d} {'recycled' if recycle else 'stopped'}")
+    if recycle:
+        sys.exit(RECYCLE_EXIT_CODE)
+
+
+def heartbeat(database, owner, stop):
+    db = connect(database)
+    while not stop.wait(LEASE_DURATION / 3):
+        try:
+            extend_leases(db, owner, LEASE_DURATION)
+        except ServerSelectionTimeoutError:
+            db = connect(database)
+
+
+def worker(
+    identifier,
+    database,
+    run_id,
+    lock,
+    low_priority=False,
+    events=None,
+    control=None,
+    max_tasks=None,
+    max_rss=None,
+    budget=None,
+    cores=None,
+):
+    """Claims leased batches of jobs of the run from the database until none are left"""
+    own_process_group()
+    if low_priority:
+        os.nice(LOW_PRIORITY_NICENESS)
+    set_core_budget(cores, identifier)
+    db = connect(database)
+    owner = f"{socket.gethostname()}:{os.getpid()}"
+    stop = threading.Event()
+    threading.Thread(target=heartbeat, args=(database, owner, stop), daemon=True).start()
+
+    with lock:
+        tprint(f"Worker {identifier:2d} ({owner}) started")
+
+    def on_flush(tags):
+        indices, request_ids = split_tags(tags)
+        if request_ids:
+            complete_requests(db, request_ids)
+        if indices:
+            complete_jobs(db, run_id, indices)
+        if control is not None:
+            control.put(("committed", identifier, tags))
+
+    def on_fail(tags):
+        # Jobs whose results could not be stored go back to other workers right away instead of having their
+        # leases extended by the heartbeat until this worker exits
+        indices, request_ids = split_tags(tags)
+        for request_id in request_ids:
+            release_request(db, request_id, owner=owner)
+        for index in indices:
+            release_job(db, run_id, index, owner=owner)
+
+    curves = CurveCache(CURVE_CACHE_SIZE)
+    computed, recycle = 0, False
+    lane = PriorityLane(db, owner)
+    with ResultWriter(
+        database,
+        on_flush=on_flush,
+        on_write=on_write(identifier, events),
+        on_fail=on_fail,
+    ) as writer:
+        while not recycle:
+            request = lane.claim()
+            if request is not None:
+                db_curve, job = request
+                if budget is not None:
+                    budget.acquire(identifier, job.get("memory", 0))
+                if control is not None:
+                    control.put(("job", identifier, job_tag(job), request, False))
+                compute_job(identifier, curves.get(db_curve), job, writer, lock, events, control)
+                if budget is not None:
+                    budget.release(identifier)
+                computed += len(job["tasks"])
+                recycle = exhausted(computed, max_tasks, max_rss)
+                continue
+            jobs = claim_jobs(db, run_id, owner, CLAIM_BATCH_SIZE, LEASE_DURATION)
+            if not jobs:
+                # Jobs leased by other workers are either completed or requeued when their lease expires
+                if get_run_progress(db, run_id)[1] == 0:
+                    break
+                time.sleep(POLL_INTERVAL)
+                continue
+            db_curves = {
+                db_curve["name"]: db_curve
+                for db_curve in get_curves(db, query={"name": [job["curve"] for job in jobs]})
+            }
+            pending = [(db_curves[job["curve"]], job) for job in jobs]
+            if control is not None:
+                # Claimed jobs are lost with this worker until their results are stored, started or not
+                for job in jobs:
+                    control.put(("job", identifier, job_tag(job), (None, job), False))
+            while pending:
+                # Jobs of the batch that fit into the memory budget go first
+                if budget is None:
+                    db_curve, job = pending.pop(0)
+                else:
+                    db_curve, job = reserve_deferred(budget, identifier, pending, True)
+                compute_job(identifier, curves.get(db_curve), job, writer, lock, events, control)
+                if budget is not None:
+                    budget.release(identifier)
+                computed += len(job["tasks"])
+            # Recycle only between claimed batches, so that no leased job is left behind
+            recycle = exhausted(computed, max_tasks, max_rss)
+    stop.set()
+
+    with lock:
+        tprint(f"Worker {identifier:2d} ({owner}) {'recycled' if recycle else 'stopped'}")
+    if recycle:
+        sys.exit(RECYCLE_EXIT_CODE)
+
 
-        for i in range(3):  # TODO move to db_handler?
-            try:
-                solved = is_solved(db, curve, trait, params)
-                break
-            except ServerSelectionTimeoutError:
-                tprint(f"Server timeout: Reconnection attempt {i}")
-                db = connect(database)
+def requeue_local(database, queue, lock):
+    db = connect(database)
+
+    def requeue(payload, position, status):
+        db_curve, job = payload
+        abandon_task(job, position, status)
+        if "index" not in job:
+            # Requests go back to the database, where any worker can claim them
+            release_request(db, job["_id"], job.get("abandoned"), job["lease"]["owner"])
+            return False
+        job["attempts"] = job.get("attempts", 1) + 1
+        job["requeued"] = True
+        with lock:
+            tprint(f"Requeued job {job['index']} ({db_curve['name']})")
+        queue.put((db_curve, job))
+        return True
+
+    return requeue
+
+
+def requeue_leased(database, run_id, lock):
+    db = connect(database)
+
+    def requeue(payload, position, status):
+        _, job = payload
+        abandon_task(job, position, status)
+        # Only the lease of the lost worker is released, the job may have been claimed again meanwhile
+        if "index" not in job:
+            release_request(db, job["_id"], job.get("abandoned"), job["lease"]["owner"])
+        else:
+            release_job(db, run_id, job["index"], job.get("abandoned"), job["lease"]["owner"])
+        with lock:
+            tprint(f"Released job {job_tag(job)} ({job['curve']})")
+        # Workers poll the database, there is no local queue to keep draining
+        return False
 
-        if solved:
-            continue
+    return requeue
+
+
+def coordinator(database, run, lock, metrics=None):
+    """Reports the progress of a run computed by workers until all of its jobs are done"""
+    db = connect(database)
+    while True:
+        watermark, remaining = get_run_progress(db, run["_id"])
+        store_run_progress(db, run["_id"], watermark, [], remaining == 0)
+        if metrics is not None:
+            metrics.progress(remaining)
+        with lock:
+            tprint(
+                f"Run {run['_id']}: {run['jobs'] - remaining}/{run['jobs']} jobs done,"
+                f" watermark {watermark}"
+            )
+        if remaining == 0:
+            return
+        time.sleep(CHECKPOINT_INTERVAL)
 
-        trait_result = TRAITS[trait](curve, **params)
-        if not trait_result:
-            continue
 
-        for i in range(3):
-            try:
-                store_trait_result(db, curve, trait, params, trait_result)
-                break
-            except ServerSelectionTimeoutError:
-                tprint(f"Server timeout: Reconnection attempt {i}")
-                db = connect(database)
+def poll_progress(database, run_id, metrics, stop):
+    """Feeds the jobs left in a run computed by several hosts to the metrics of one of them"""
+    db = connect(database)
+    while True:
+        try:
+            metrics.progress(get_run_progress(db, run_id)[1])
+        except ServerSelectionTimeoutError:
+            db = connect(database)
+        if stop.wait(CHECKPOINT_INTERVAL):
+            return
 
 
 def main():
@@ -108,8 +764,8 @@ def main():
         "-t",
         "--trait_name",
         metavar="trait_name",
-        help="Trait identifier",
-        required=True,
+        nargs="+",
+        help="Trait identifiers or 'all', computed in a single pass over the curves (required unless resuming a run)",
     )
     parser.add_argument(
         "-c", "--category", nargs="+", help="Curve category", default=["all"]
@@ -141,36 +797,315 @@ def main():
     )
     parser.add_argument("--verbose", action="store_true", default=False)
     parser.add_argument(
-        "--skip",
+        "--resume",
+        metavar="RUN_ID",
+        help="Resume a previously planned run from its last checkpoint",
+    )
+    parser.add_argument(
+        "--retry-timeouts",
+        action="store_true",
+        default=False,
+        help="Plan a low-priority run recomputing timed out results with the next larger time budget",
+    )
+    parser.add_argument(
+        "--plan",
+        action="store_true",
+        default=False,
+        help="Print how many results are done, timed out, failed or missing and the estimated core-hours, then exit",
+    )
+    parser.add_argument(
+        "--submit",
+        metavar="CURVE_NAME",
+        nargs="+",
+        help="Queue the traits of the given curves ahead of all runs, to be computed by any running computation",
+    )
+    parser.add_argument(
+        "--priority",
+        type=int,
+        default=1,
+        help="Priority of submitted curves, higher is computed first (default: 1)",
+    )
+    parser.add_argument(
+        "--group-by-field",
+        action="store_true",
+        default=False,
+        help="Plan the curves over the same field next to each other, so that workers reuse the field, polynomial"
+        " rings and extensions they constructed, instead of the longest jobs first",
+    )
+    parser.add_argument(
+        "--prefactor",
+        action="store_true",
+        default=False,
+        help="When planning or resuming a run (not with --worker), strip small factors and factors shared"
+        " across all integers the run factors, in bulk, into the disk factorization cache of this host, which"
+        " only workers on this host read; without the disk cache this does nothing",
+    )
+    parser.add_argument(
+        "--metrics-port",
         type=int,
-        default=0,
-        help="Skip given number of curve-parameter combinations",
+        help="Serve live metrics in Prometheus text format on localhost at the given port",
+    )
+    parser.add_argument(
+        "--stats-file",
+        help="Periodically rewrite the given file with live metrics in Prometheus text format",
+    )
+    parser.add_argument(
+        "--max-tasks-per-worker",
+        type=int,
+        help="Replace a worker process with a fresh one after it computed the given number of tasks",
+    )
+    parser.add_argument(
+        "--max-rss",
+        type=int,
+        metavar="MIB",
+        help="Replace a worker process with a fresh one once its resident memory exceeds the given size in MiB",
+    )
+    parser.add_argument(
+        "--memory",
+        type=float,
+        metavar="MIB",
+        help="Memory budget of the node in MiB: jobs wait (or let cheaper jobs go first) until the memory"
+        " they are expected to need is free",
+    )
+    parser.add_argument(
+        "--hard-timeout",
+        type=float,
+        default=HARD_TIMEOUT,
+        help=f"Kill a worker stuck on a single task for longer than the given number of seconds"
+        f" (scaled with the timeout tier) and requeue its job, 0 disables it (default: {HARD_TIMEOUT})",
+    )
+    parser.add_argument(
+        "--portfolio",
+        type=int,
+        default=1,
+        metavar="N",
+        help="Race up to N factorization strategies (PARI, ECM, quadratic sieve) on each hard composite while"
+        " cores beyond one per worker process are idle, e.g. at the end of a run (default: 1, no racing)",
+    )
+    mode = parser.add_mutually_exclusive_group()
+    mode.add_argument(
+        "--coordinator",
+        action="store_true",
+        default=False,
+        help="Plan (or resume) a run for workers and report its progress without computing",
+    )
+    mode.add_argument(
+        "--worker",
+        metavar="RUN_ID",
+        help="Compute jobs of the given run leased from the database, on any number of hosts",
     )
 
     args = parser.parse_args()
+    if args.worker:
+        args.resume = args.worker
+    if (args.plan or args.submit) and not args.trait_name:
+        parser.error("--plan and --submit require -t/--trait_name")
+    if not (args.trait_name or args.resume):
+        parser.error("the following arguments are required: -t/--trait_name")
+    traits = list(TRAITS) if args.trait_name and "all" in args.trait_name else args.trait_name
+    for trait in traits or []:
+        if trait not in TRAITS:
+            parser.error(f"trait {trait} is not implemented")
 
     queue = Queue(1000)
+    done = Queue()
     lock = Lock()
 
     with lock:
         tprint("Script start")
 
-    consumers = [
-        Process(target=consumer, args=(i, args.database, args.trait_name, queue, lock))
-        for i in range(1, args.jobs + 1)
-    ]
-    for proc in consumers:
-        proc.daemon = True
-        proc.start()
+    if args.plan:
+        print_plan(args.database, traits, args)
+        return
+
+    if args.submit:
+        submit(args.database, traits, args.submit, args.priority, lock)
+        return
 
-    producer(args.database, args.trait_name, args, queue, lock)
+    if args.resume:
+        run = get_run(connect(args.database), args.resume)
+        if run is None:
+            parser.error(f"run {args.resume} does not exist")
+    elif args.retry_timeouts:
+        run = plan_retry(args.database, traits, args, lock)
+    else:
+        run = plan_run(args.database, traits, args, lock)
 
-    for proc in consumers:
-        proc.join()
+    # Seeds reach the workers through the disk cache only, they are computed once by the planning process
+    if args.prefactor and not args.worker:
+        if FACTOR_CACHE.persistent():
+            prefactor(args.database, run, lock)
+        else:
+            with lock:
+                tprint("Skipping --prefactor, the disk factorization cache is disabled")
+
+    events, metrics = None, None
+    if args.metrics_port or args.stats_file:
+        local = not (args.worker or args.coordinator)
+        # A coordinator computes nothing, its metrics are the progress of the run
+        events = None if args.coordinator else Queue()
+        remaining = run["jobs"] - run["watermark"] - len(run["done"]) if local else 0
+        metrics = Metrics(events, jobs=remaining, queue=queue if local else None)
+        if args.metrics_port:
+            metrics.serve(args.metrics_port)
+        if args.stats_file:
+            metrics.write_to(args.stats_file)
+        metrics.start()
+
+    if args.coordinator:
+        coordinator(args.database, run, lock, metrics)
+        if metrics is not None:
+            metrics.stop()
+        with lock:
+            tprint("Script finish")
+        return
+
+    control = Queue()
+    max_rss = args.max_rss * 2**20 if args.max_rss else None
+    budget = MemoryBudget(args.memory, args.jobs) if args.memory else None
+    # Inherited by the worker processes, which race strategies on the cores not taken by one of them
+    set_portfolio(args.portfolio)
+    cores = CoreBudget(max(available_cores() - args.jobs, 0), args.jobs) if args.portfolio > 1 else None
+
+    def log(message):
+        with lock:
+            tprint(message)
+
+    if args.worker:
+
+        def spawn(identifier, drain=False):
+            proc = Process(
+                target=worker,
+                args=(
+                    identifier,
+                    args.database,
+                    run["_id"],
+                    lock,
+                    run.get("retry", False),
+                    events,
+                    control,
+                    args.max_tasks_per_worker,
+                    max_rss,
+                    budget,
+                    cores,
+                ),
+            )
+            if budget is not None:
+                budget.release(identifier)
+            if cores is not None:
+                cores.give(identifier)
+            proc.start()
+            return proc
+
+        requeue = requeue_leased(args.database, run["_id"], lock)
+        stop = threading.Event()
+        if metrics is not None:
+            # The jobs left in the run are shared by all hosts, they are polled from the database
+            threading.Thread(
+                target=poll_progress, args=(args.database, run["_id"], metrics, stop), daemon=True
+            ).start()
+        Supervisor(spawn, args.jobs, control, log, requeue, args.hard_timeout).run()
+        stop.set()
+    else:
+
+        def spawn(identifier, drain=False):
+            proc = Process(
+                target=consumer,
+                args=(
+                    identifier,
+                    args.database,
+                    queue,
+                    done,
+                    lock,
+                    run.get("retry", False),
+                    events,
+                    control,
+                    args.max_tasks_per_worker,
+                    max_rss,
+                    budget,
+                    cores,
+                ),
+            )
+            proc.daemon = True
+            # The reservation and the cores lent to a replaced consumer are gone with it
+            if budget is not None:
+                budget.release(identifier)
+            if cores is not None:
+                cores.give(identifier)
+            proc.start()
+            if drain:
+                queue.put((None, None))
+            return proc
+
+        requeue = requeue_local(args.database, queue, lock)
+        supervisor = Supervisor(spawn, args.jobs, control, log, requeue, args.hard_timeout)
+        supervising = threading.Thread(target=supervisor.run)
+        supervising.start()
+
+        checkpoint = threading.Thread(
+            target=checkpointer, args=(args.database, run, done, lock)
+        )
+        checkpoint.start()
+
+        try:
+            producer(args.database, run, args, queue, lock)
+            supervising.join()
+        except BaseException:
+            # Consumers have their own process groups and do not get the interrupt of the terminal
+            supervisor.stop()
+            supervising.join()
+            raise
+
+        done.put(None)
+        checkpoint.join()
+
+    if metrics is not None:
+        metrics.stop()
 
     with lock:
         tprint("Script finish")
 
 
+def test_plan_chunks():
+    cost_model = CostModel()
+    jobs = [([("cofactor", {})], bits, (bits, bits % 3)) for bits in (128, 512, 256, 384, 64)]
+    plan = list(plan_chunks(cost_model, jobs, chunk_size=2))
+    assert [item[0] for _, item in plan] == [512, 128, 384, 256, 64]
+    assert list(plan_chunks(cost_model, [], chunk_size=2)) == []
+    plan = list(plan_chunks(cost_model, jobs, group=True, chunk_size=5))
+    assert [item[1] for _, item in plan] == [2, 2, 1, 1, 0]
+
+
+def test_group_by_field():
+    plan = [(5.0, ("a", "p")), (4.0, ("b", "q")), (3.0, ("c", "q")), (1.0, ("d", "p")), (2.0, ("e", "r"))]
+    assert [item[0] for _, item in group_by_field(plan)] == ["b", "c", "a", "d", "e"]
+
+
+def test_priority_lane_backs_off(monkeypatch):
+    import dissect.utils.compute_db as module
+
+    now, waiting, polls = [0.0], [], []
+
+    def claim(db, owner):
+        polls.append(now[0])
+        return waiting.pop() if waiting else None
+
+    monkeypatch.setattr(module, "claim_priority", claim)
+    monkeypatch.setattr(module.time, "monotonic", lambda: now[0])
+    lane = PriorityLane(None, "owner")
+    for _ in range(40):
+        lane.claim()
+        now[0] += 1
+    assert polls == [0, 1, 3, 7, 15, 31]
+    waiting.append("request")
+    now[0] = 47
+    assert lane.claim() == "request"
+    # A claimed request resets the interval
+    assert lane.claim() is None
+    now[0] += 1
+    lane.claim()
+    assert polls[-3:] == [47, 47, 48]
+
+
 if __name__ == "__main__":
     main()
@@ -5,6 +5,19 @@ import sys
 from dissect.traits import TRAITS
 from dissect.utils.custom_curve import CustomCurve
 from dissect.utils.database_handler import _cast_sage_types
+from dissect.utils.telemetry import measure
+
+
+def compute_curve(db_curve, trait, params_list):
+    """Computes the trait with each of the params on the curve given as a JSON record"""
+    curve = CustomCurve(db_curve)
+    results = []
+    for params in params_list:
+        result = {"curve": curve.name()}
+        result["params"] = params
+        result["result"], result["stats"] = measure(TRAITS[trait], curve, **params)
+        results.append(_cast_sage_types(result))
+    return results
 
 
 def main():
@@ -44,12 +57,9 @@ def main():
         curves = curves["curves"]
 
     for curve in curves:
-        curve = CustomCurve(curve)
-        for params in TRAITS[args.trait].params_iter():
-            result = {"curve": curve.name()}
-            result["params"] = params
-            result["result"] = TRAITS[args.trait](curve, **params)
-            results["data"].append(result)
+        results["data"].extend(
+            compute_curve(curve, args.trait, list(TRAITS[args.trait].params_iter()))
+        )
 
     json.dump(
         _cast_sage_types(results),
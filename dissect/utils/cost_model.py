@@ -0,0 +1,208 @@
+from typing import Any, Dict, Iterable, List, Tuple
+
+from pymongo.database import Database
+
+from dissect.utils.database_handler import _params_key
+
+# Seed estimates: (seconds for a 256-bit curve, exponent of the field bits, exponent of the parameter value).
+# They only need to be right relative to each other; recorded runtimes take precedence once available.
+SEED_COSTS = {
+    "cofactor": (1e-4, 0, 0),
+    "weierstrass": (1e-4, 0, 0),
+    "brainpool_overlap": (1e-4, 0, 0),
+    "x962_invariant": (1e-3, 1, 0),
+    "pow_distance": (1e-4, 1, 0),
+    "volcano": (1e-3, 1, 0),
+    "q_torsion": (1e-2, 1, 0),
+    "embedding": (0.5, 2, 0),
+    "discriminant": (5.0, 3, 0),
+    "class_number": (5.0, 3, 0),
+    "square_4p1": (5.0, 3, 0),
+    "small_prime_order": (2.0, 2, 0),
+    "twist_order": (5.0, 3, 1),
+    "trace_factorization": (2.0, 3, 1),
+    "conductor": (5.0, 3, 1),
+    "kn_factorization": (10.0, 3, 0.5),
+    "multiples_x": (0.05, 2, 0),
+    "hamming_x": (0.1, 1, 3),
+    "isogeny_neighbors": (0.05, 2, 1),
+    "division_polynomials": (0.2, 2, 2),
+    "torsion_extension": (0.5, 2, 2),
+    "isogeny_extension": (0.5, 2, 2),
+}
+DEFAULT_SEED_COST = (1.0, 2, 0)
+REFERENCE_BITS = 256
+
+# Memory a worker process needs besides Sage itself, in the same form as the seed costs (MiB at 256 bits).
+# Traits working in extension fields or with division polynomials grow with the degree given by their parameter.
+SEED_MEMORY = {
+    "torsion_extension": (1.0, 1, 2),
+    "isogeny_extension": (1.0, 1, 2),
+    "division_polynomials": (0.5, 1, 2),
+    "hamming_x": (16.0, 1, 0),
+    "discriminant": (64.0, 1, 0),
+    "class_number": (64.0, 1, 0),
+    "conductor": (64.0, 1, 0),
+    "twist_order": (64.0, 1, 0),
+    "kn_factorization": (64.0, 1, 0),
+    "square_4p1": (64.0, 1, 0),
+    "trace_factorization": (64.0, 1, 0),
+}
+DEFAULT_SEED_MEMORY = (16.0, 0, 0)
+BASE_MEMORY = 256.0
+
+
+class CostModel:
+    """Expected runtime of trait computations seeded by heuristics and refined by recorded runtimes"""
+
+    def __init__(self):
+        self._observed = {}
+        self._estimates = {}
+        self._memory = {}
+
+    def observe(self, trait: str, params: Dict[str, Any], bits: int, seconds: float, count: int = 1):
+        key = (trait, _params_key(params), bits)
+        total, n = self._observed.get(key, (0.0, 0))
+        self._observed[key] = (total + seconds * count, n + count)
+        self._estimates.clear()
+
+    def load(self, db: Database, traits: Iterable[str]):
+        pipeline = [
+            {"$match": {"trait": {"$in": list(traits)}}},
+            {
+                "$group": {
+                    "_id": {
+                        "trait": "$trait",
+                        "params": "$params",
+                        "bits": "$curve.bits",
+                    },
+                    "wall": {"$avg": "$wall"},
+                    "rss": {"$min": "$rss"},
+                    "count": {"$sum": 1},
+                }
+            },
+        ]
+        for record in db["telemetry"].aggregate(pipeline):
+            group = record["_id"]
+            self.observe(
+                group["trait"],
+                group["params"],
+                group["bits"],
+                record["wall"],
+                record["count"],
+            )
+            if record["rss"]:
+                self.observe_memory(group["trait"], group["params"], group["bits"], record["rss"] / 2**20)
+        return self
+
+    def observe_memory(self, trait: str, params: Dict[str, Any], bits: int, mib: float):
+        # Recorded RSS is the peak of the worker during the task, including what it held before; the least one
+        # seen for a task bounds what it needs
+        key = (trait, _params_key(params), bits)
+        self._memory[key] = min(self._memory.get(key, mib), mib)
+
+    def memory(self, trait: str, params: Dict[str, Any], bits: int) -> float:
+        """Expected memory in MiB of a worker process computing the task"""
+        observed = self._memory.get((trait, _params_key(params), bits))
+        if observed:
+            return observed
+        base, bits_exponent, param_exponent = SEED_MEMORY.get(trait, DEFAULT_SEED_MEMORY)
+        mib = base * (bits / REFERENCE_BITS) ** bits_exponent
+        for value in params.values():
+            if isinstance(value, int) and value > 0:
+                mib *= value**param_exponent
+        return BASE_MEMORY + mib
+
+    def footprint(self, tasks: Iterable[Tuple[str, Dict[str, Any]]], bits: int) -> float:
+        """Memory in MiB of a job, its tasks run one after another"""
+        return max((self.memory(t, p, bits) for t, p in tasks), default=BASE_MEMORY)
+
+    def seed(self, trait: str, params: Dict[str, Any], bits: int) -> float:
+        base, bits_exponent, param_exponent = SEED_COSTS.get(trait, DEFAULT_SEED_COST)
+        cost = base * (bits / REFERENCE_BITS) ** bits_exponent
+        for value in params.values():
+            if isinstance(value, int) and value > 0:
+                cost *= value**param_exponent
+        return cost
+
+    def estimate(self, trait: str, params: Dict[str, Any], bits: int) -> float:
+        key = _params_key(params)
+        if (trait, key, bits) not in self._estimates:
+            self._estimates[(trait, key, bits)] = self._estimate(trait, params, key, bits)
+        return self._estimates[(trait, key, bits)]
+
+    def _estimate(self, trait, params, key, bits):
+        observed = self._observed.get((trait, key, bits))
+        if observed:
+            return observed[0] / observed[1]
+        # Rescale the seed by the runtime observed on the closest bit length
+        nearest = min(
+            (b for t, k, b in self._observed if t == trait and k == key),
+            key=lambda b: abs(b - bits),
+            default=None,
+        )
+        if nearest is None:
+            return self.seed(trait, params, bits)
+        total, n = self._observed[(trait, key, nearest)]
+        return total / n * self.seed(trait, params, bits) / self.seed(trait, params, nearest)
+
+    def order(
+        self, jobs: Iterable[Tuple[List[Tuple[str, Dict[str, Any]]], int, Any]]
+    ) -> List[Tuple[float, Any]]:
+        """Returns (cost, item) pairs of ([(trait, params), ...], bits, item) jobs, longest expected first"""
+        estimated = [
+            (sum(self.estimate(t, p, bits) for t, p in tasks), bits, index, item)
+            for index, (tasks, bits, item) in enumerate(jobs)
+        ]
+        estimated.sort(key=lambda x: (-x[0], -x[1], x[2]))
+        return [(cost, item) for cost, _, _, item in estimated]
+
+
+def makespan_bound(total: float, largest: float, jobs: int) -> float:
+    """Lower bound on the makespan of jobs with the given total and largest cost scheduled on jobs workers"""
+    return max(total / jobs, largest)
+
+
+def test_seed_scales_with_bits_and_params():
+    model = CostModel()
+    assert model.seed("cofactor", {}, 512) == SEED_COSTS["cofactor"][0]
+    assert model.seed("discriminant", {}, 512) == 8 * model.seed("discriminant", {}, 256)
+    assert model.seed("twist_order", {"deg": 2}, 256) == 2 * model.seed("twist_order", {"deg": 1}, 256)
+    assert model.seed("unknown", {}, 256) == DEFAULT_SEED_COST[0]
+
+
+def test_observed_runtimes_take_precedence():
+    model = CostModel()
+    model.observe("discriminant", {}, 256, 3.0)
+    model.observe("discriminant", {}, 256, 1.0)
+    assert model.estimate("discriminant", {}, 256) == 2.0
+    # Other bit lengths rescale the runtime observed on the closest one by the seed
+    assert model.estimate("discriminant", {}, 512) == 16.0
+    model.observe("discriminant", {}, 512, 4.0)
+    assert model.estimate("discriminant", {}, 512) == 4.0
+
+
+def test_order_longest_first():
+    model = CostModel()
+    jobs = [
+        ([("cofactor", {})], 256, "cheap"),
+        ([("discriminant", {}), ("cofactor", {})], 256, "expensive"),
+        ([("cofactor", {})], 512, "larger"),
+    ]
+    assert [item for _, item in model.order(jobs)] == ["expensive", "larger", "cheap"]
+
+
+def test_memory():
+    model = CostModel()
+    assert model.memory("cofactor", {}, 256) == BASE_MEMORY + DEFAULT_SEED_MEMORY[0]
+    assert model.memory("division_polynomials", {"l": 4}, 256) == BASE_MEMORY + 0.5 * 16
+    model.observe_memory("cofactor", {}, 256, 400.0)
+    model.observe_memory("cofactor", {}, 256, 300.0)
+    assert model.memory("cofactor", {}, 256) == 300.0
+    assert model.footprint([("cofactor", {}), ("discriminant", {})], 256) == BASE_MEMORY + 64.0
+    assert model.footprint([], 256) == BASE_MEMORY
+
+
+def test_makespan_bound():
+    assert makespan_bound(100.0, 10.0, 4) == 25.0
+    assert makespan_bound(100.0, 60.0, 4) == 60.0
@@ -1,17 +1,57 @@
+from collections import OrderedDict
+
 from sage.all import (
     EllipticCurve,
     ZZ,
-    GF,
     Integers,
-    PolynomialRing,
     sqrt,
 )  # import sage library
-from dissect.utils.curve_form import dict_to_poly, CurveForm
+from dissect.utils.curve_form import CurveForm
+from dissect.utils.extension_tower import ExtensionTower
+from dissect.utils.field_context import FIELD_CONTEXTS, field_key, small_field_polynomial_ring
 from dissect.utils.utils import Factorization
 
 
 class CustomCurve:
-    """Class for unified representation of curves from databases"""
+    """Class for unified representation of curves from databases
+
+    Only integers are parsed on construction. The field, the curve form, the elliptic curve, its generator and
+    j-invariant are constructed by Sage on first access, so traits and filters using integers only never pay
+    for them.
+    """
+
+    __slots__ = (
+        "_name",
+        "_order",
+        "_category",
+        "_params",
+        "_cofactor",
+        "_cardinality",
+        "_nbits",
+        "_field_dict",
+        "_context",
+        "_field",
+        "_field_type",
+        "_characteristic",
+        "_degree",
+        "_q",
+        "_field_bits",
+        "_form_desc",
+        "_form",
+        "_ec",
+        "_tower",
+        "_standard",
+        "_example",
+        "_trace",
+        "_j_invariant",
+        "_embedding_degree",
+        "_cm_discriminant",
+        "_cm_factorization",
+        "_generator_dict",
+        "_generator",
+        "_desc",
+        "_seed",
+    )
 
     def __init__(self, db_curve):
         self._name = db_curve["name"]
@@ -21,19 +61,17 @@ class CustomCurve:
         self._cofactor = ZZ(db_curve["cofactor"])
         self._cardinality = self._order * self._cofactor
         self._nbits = self._order.nbits()
+        self._context = None
         self._field = None
-        self._field_type = None
-        self._q = None
-        self._field_bits = None
         self._form = None
         self._ec = None
+        self._tower = None
         self._standard = (
             db_curve.get("standard", False) or "sim" not in db_curve["name"]
         )
         self._example = db_curve.get("example", False)
         self.set_field(db_curve["field"])
-        self.set_form(db_curve["form"])
-        self.set_ec()
+        self._form_desc = db_curve["form"]
         # Non-mandatory attributes:
         self._trace = None
         self._j_invariant = None
@@ -73,7 +111,15 @@ class CustomCurve:
     def nbits(self):
         return self._nbits
 
+    def context(self):
+        """Field context shared with the other curves over the same field"""
+        if self._context is None:
+            self._context = FIELD_CONTEXTS.get(*field_key(self._field_dict))
+        return self._context
+
     def field(self):
+        if self._field is None:
+            self._field = self.context().field()
         return self._field
 
     def field_type(self):
@@ -86,9 +132,13 @@ class CustomCurve:
         return self._q
 
     def form(self):
+        if self._form is None:
+            self.set_form(self._form_desc)
         return self._form
 
     def ec(self):
+        if self._ec is None:
+            self.set_ec()
         return self._ec
 
     def description(self):
@@ -98,15 +148,22 @@ class CustomCurve:
         return self._seed
 
     def is_over_binary(self):
-        return self._field.characteristic() % 2 == 0
+        return self._characteristic % 2 == 0
 
     def a(self):
-        return self._form.a()
+        return self.form().a()
 
     def b(self):
-        return self._form.b()
+        return self.form().b()
 
     def generator(self):
+        if self._generator is None and self._generator_dict is not None:
+            generator, self._generator_dict = self._generator_dict, None
+            try:
+                x, y = self.form().point(generator["x"], generator["y"])
+                self._generator = self.ec()(x, y)
+            except TypeError:
+                pass
         return self._generator
 
     def embedding_degree(self):
@@ -120,9 +177,11 @@ class CustomCurve:
         return self._trace
 
     def j_invariant(self):
+        if self._j_invariant is None:
+            self._j_invariant = self.ec().j_invariant()
         j = self._j_invariant
         if self.is_over_binary():
-            j = self._field(j).to_integer()
+            j = self.field()(j).to_integer()
         return j
 
     def cm_discriminant(self):
@@ -147,34 +206,33 @@ class CustomCurve:
         return self._cm_factorization
 
     def is_over_extension(self):
-        return not (self.field().is_prime_field() or self.is_over_binary())
+        return not (self.is_over_prime() or self.is_over_binary())
 
     def is_over_prime(self):
-        return self.field().is_prime_field()
+        return self._degree == 1
 
     def set_field(self, field_dict):
+        self._field_dict = field_dict
+        self._context = None
+        self._field = None
         self._field_type = field_dict["type"]
         if field_dict["type"] == "Prime":
-            p = ZZ(field_dict["p"])
-            self._field = GF(p, proof=False)
-            self._q = p
-            self._field_bits = self._q.nbits()
+            self._characteristic = ZZ(field_dict["p"])
+            self._degree = ZZ(1)
         else:
-            base = ZZ(2) if field_dict["type"] == "Binary" else ZZ(field_dict["base"])
-            degree = ZZ(field_dict["degree"])
-            modulus = dict_to_poly(field_dict["poly"], GF(base)["w"])
-            self._field = GF(base**degree, "w", modulus, proof=False)
-            self._q = base**degree
-            self._field_bits = self._q.nbits()
+            self._characteristic = ZZ(2) if field_dict["type"] == "Binary" else ZZ(field_dict["base"])
+            self._degree = ZZ(field_dict["degree"])
+        self._q = self._characteristic**self._degree
+        self._field_bits = self._q.nbits()
 
     def set_form(self, form_desc):
         if form_desc in ["Edwards", "TwistedEdwards"]:
             a = {"raw": "0x1"} if form_desc == "Edwards" else self._params["a"]
             d = self._params["d"]
-            self._form = CurveForm(self._field, {"form": form_desc, "a": a, "d": d})
+            self._form = CurveForm(self.field(), {"form": form_desc, "a": a, "d": d})
         else:
             a, b = self._params["a"], self._params["b"]
-            self._form = CurveForm(self._field, {"form": form_desc, "a": a, "b": b})
+            self._form = CurveForm(self.field(), {"form": form_desc, "a": a, "b": b})
 
     def set_ec(self):
         if self.is_over_binary():
@@ -184,13 +242,14 @@ class CustomCurve:
         self._ec.set_order(self._cardinality, num_checks=0)
 
     def set_generator(self, db_curve):
+        """Keeps the coordinates of the generator, converted to a point by generator()"""
+        self._generator_dict = None
         try:
             generator = db_curve["generator"]
             x, y = generator["x"], generator["y"]
             to_skip = ["", None]
             if x not in to_skip and y not in to_skip:
-                x, y = self.form().point(x, y)
-                self._generator = self._ec(x, y)
+                self._generator_dict = {"x": x, "y": y}
         except (KeyError, TypeError):
             pass
 
@@ -198,7 +257,6 @@ class CustomCurve:
         try:
             properties = db_curve["properties"]
         except KeyError:
-            self._j_invariant = self._ec.j_invariant()
             self._trace = self._q + 1 - self._cardinality
             return
         try:
@@ -212,57 +270,33 @@ class CustomCurve:
         try:
             self._j_invariant = ZZ(properties["j_invariant"])
         except KeyError:
-            self._j_invariant = self._ec.j_invariant()
+            pass
         try:
             self._trace = ZZ(properties["trace"])
         except KeyError:
             self._trace = self._q + 1 - self._cardinality
 
+    def tower(self):
+        """Traces, cardinalities and curves over the extensions of the field"""
+        if self._tower is None:
+            self._tower = ExtensionTower(self)
+        return self._tower
+
     def extended_ec(self, deg):
-        ext_q = self._q**deg
-        prime_field = GF(self._field.characteristic())
-        ext_field = GF(
-            ext_q,
-            name="z",
-            modulus=prime_field["z"].irreducible_element(deg * self._field.degree()),
-        )
-        if self.is_over_prime():
-            return self._ec.base_extend(ext_field)
-        # perhaps unnecessarily complicated coercion (str.replace :P)
-        h = ext_field.gen() ** ((ext_q - 1) // (self._q - 1))
-        try:
-            hf = GF(self._q, name="h", modulus=h.minpoly())
-        except ValueError:
-            return None
-        i = hf.hom([h])
-        new_coeffs = list(
-            map(
-                lambda x: i(hf(str(x).replace(str(self._field.gen()), "h"))),
-                self._ec.a_invariants(),
-            )
-        )
-        ext_ec = EllipticCurve(ext_field, new_coeffs)
-        # compute order of extended ec
-        s_old, s_new = 2, self._trace
-        for _ in range(2, deg + 1):
-            s_old, s_new = s_new, self._trace * s_new - self._q * s_old
-        ext_ec.set_order(self._q**deg + 1 - s_new, num_checks=0)
-        return ext_ec
+        """returns the curve over deg-th relative extension, the field embedded by a field homomorphism"""
+        return self.tower().curve(deg)
 
     def extended_cardinality(self, deg):
         """returns curve cardinality over deg-th relative extension"""
-        s_old, s_new = 2, self._trace
-        for _ in range(2, deg + 1):
-            s_old, s_new = s_new, self._trace * s_new - self._q * s_old
-        return self._q**deg + 1 - s_new
+        return self.tower().cardinality(deg)
 
     def extended_trace(self, deg):
         """returns the trace of Frobenius over deg-th relative extension"""
-        return self._q**deg + 1 - self.extended_cardinality(deg)
+        return self.tower().trace(deg)
 
     def extended_frobenius_disc(self, deg=1):
         """returns the Frobenius discriminant (i.e. t^2-4q) over deg-th relative extension"""
-        return self.extended_trace(deg) ** 2 - 4 * self._q**deg
+        return self.tower().frobenius_disc(deg)
 
     def is_torsion_cyclic(self, prime, deg, iterations=20):
         """True if the l-torsion is cyclic and False otherwise (bicyclic). Note that this is probabilistic only."""
@@ -279,17 +313,35 @@ class CustomCurve:
 
     def eigenvalues(self, prime, s=1):
         """Computes the eigenvalues of Frobenius endomorphism in F_l, or in F_(l^2) if s=2"""
-        x = PolynomialRing(GF(prime**s), "x").gen()
+        x = small_field_polynomial_ring(ZZ(prime), s).gen()
         q = self.q()
         t = self.trace()
         f = x**2 - t * x + q
         return f.roots()
 
     def __repr__(self):
-        return f"{self._name}: {self._nbits}-bit curve in {self._form.form()} form over {self._field_type} field"
+        return f"{self._name}: {self._nbits}-bit curve in {self._form_desc} form over {self._field_type} field"
 
     def __str__(self):
         return self.__repr__()
 
     def __lt__(self, other):
         return (self._nbits, self._name) < (other.nbits(), other.name())
+
+
+class CurveCache:
+    """Bounded LRU of constructed curves keyed by their names"""
+
+    def __init__(self, size=64):
+        self._size = size
+        self._curves = OrderedDict()
+
+    def get(self, db_curve):
+        name = db_curve["name"]
+        curve = self._curves.pop(name, None)
+        if curve is None:
+            curve = CustomCurve(db_curve)
+        self._curves[name] = curve
+        if len(self._curves) > self._size:
+            self._curves.popitem(last=False)
+        return curve
@@ -1,15 +1,20 @@
 #!/usr/bin/env python3
 import bz2
+import datetime
+import itertools
 import json
 import os
-from typing import Optional, Tuple, Iterable, Dict, Any
+import uuid
+from typing import Optional, Tuple, Iterable, Dict, Any, List
 
-from pymongo import MongoClient
+from pymongo import MongoClient, ReturnDocument
 from pymongo.database import Database
-from pymongo.errors import DuplicateKeyError
+from pymongo.errors import BulkWriteError, DuplicateKeyError
 
 from dissect.traits import TRAITS
 
+DUPLICATE_KEY_ERROR = 11000
+
 
 def connect(database: Optional[str] = None) -> Database:
     client = MongoClient(database, connect=False)
@@ -22,6 +27,7 @@ def create_curves_index(db: Database) -> None:
 
 def create_trait_index(db: Database, trait: str) -> None:
     db[f"trait_{trait}"].create_index([("curve.name", 1), ("params", 1)], unique=True)
+    db[f"trait_{trait}"].create_index([("status", 1), ("curve.bits", 1)])
 
 
 def _format_curve(curve):
@@ -222,13 +228,13 @@ def _encode_ints(result: Any) -> Any:
     return result
 
 
-def store_trait_result(
-    db: Database,
+def format_trait_result(
     curve: Any,
-    trait: str,
     params: Dict[str, Any],
     result: Dict[str, Any],
-) -> bool:
+    status: str = "ok",
+    tier: int = 0,
+) -> Dict[str, Any]:
     trait_result = {}
     trait_result["curve"] = {}
     trait_result["curve"]["name"] = curve.name()
@@ -241,25 +247,451 @@ def store_trait_result(
     trait_result["curve"] = _cast_sage_types(trait_result["curve"])
     trait_result["params"] = _cast_sage_types(params)
     trait_result["result"] = _encode_ints(result)
+    trait_result["status"] = status
+    trait_result["tier"] = tier
+    return trait_result
+
+
+def store_trait_result(
+    db: Database,
+    curve: Any,
+    trait: str,
+    params: Dict[str, Any],
+    result: Dict[str, Any],
+) -> bool:
+    trait_result = format_trait_result(curve, params, result)
     try:
         return db[f"trait_{trait}"].insert_one(trait_result).acknowledged
     except DuplicateKeyError:
         return False
 
 
-def is_solved(db: Database, curve: Any, trait: str, params: Dict[str, Any]) -> bool:
-    trait_result = {"curve.name": curve.name()}
-    trait_result["params"] = _cast_sage_types(params)
-    return db[f"trait_{trait}"].find_one(trait_result) is not None
+def store_operations(db: Database, collection: str, operations: List[Any]) -> int:
+    if not operations:
+        return 0
+    try:
+        db[collection].bulk_write(operations, ordered=False)
+    except BulkWriteError as e:
+        errors = e.details.get("writeErrors", [])
+        if any(error.get("code") != DUPLICATE_KEY_ERROR for error in errors):
+            raise
+    return len(operations)
+
+
+def create_telemetry_index(db: Database) -> None:
+    db["telemetry"].create_index([("trait", 1), ("params", 1), ("curve.bits", 1)])
+
+
+def format_telemetry(
+    curve: Any, trait: str, params: Dict[str, Any], stats: Dict[str, Any]
+) -> Dict[str, Any]:
+    telemetry = {}
+    telemetry["trait"] = trait
+    telemetry["curve"] = {}
+    telemetry["curve"]["name"] = curve.name()
+    telemetry["curve"]["bits"] = curve.q().nbits()
+    telemetry["curve"] = _cast_sage_types(telemetry["curve"])
+    telemetry["params"] = _cast_sage_types(dict(params))
+    telemetry.update(stats)
+    telemetry["created"] = datetime.datetime.now(datetime.timezone.utc)
+    return telemetry
+
+
+def get_telemetry_report(
+    db: Database, query: Dict[str, Any] = None
+) -> Iterable[Dict[str, Any]]:
+    match = {}
+    if query:
+        if query.get("trait") and "all" not in query["trait"]:
+            match["trait"] = {"$in": list(query["trait"])}
+        if query.get("bits") and "all" not in query["bits"]:
+            match["curve.bits"] = {"$in": list(map(int, query["bits"]))}
+    aggregate_pipeline = [
+        {"$match": match},
+        {
+            "$group": {
+                "_id": {"trait": "$trait", "params": "$params", "bits": "$curve.bits"},
+                "count": {"$sum": 1},
+                "wall": {"$sum": "$wall"},
+                "wall_max": {"$max": "$wall"},
+                "cpu": {"$sum": "$cpu"},
+                "rss_max": {"$max": "$rss"},
+                "timeouts": {"$sum": {"$cond": [{"$eq": ["$status", "timeout"]}, 1, 0]}},
+                "failures": {"$sum": {"$cond": [{"$eq": ["$status", "failed"]}, 1, 0]}},
+            }
+        },
+        {"$sort": {"wall": -1}},
+    ]
+    for record in db["telemetry"].aggregate(aggregate_pipeline):
+        record.update(record.pop("_id"))
+        yield record
+
+
+def get_coverage(
+    db: Database, traits: Iterable[str], query: Dict[str, Any] = None
+) -> Tuple[Dict[Tuple[str, int], int], Dict[Tuple[str, Any, str, int, str], int]]:
+    """Returns curve counts per (category, bits) and result counts per (trait, params, category, bits, status)"""
+    curves = {}
+    curve_pipeline = [
+        {"$match": format_curve_query(query) if query else dict()},
+        {"$group": {"_id": {"category": "$category", "bits": "$field.bits"}, "count": {"$sum": 1}}},
+    ]
+    for record in db["curves"].aggregate(curve_pipeline, allowDiskUse=True):
+        curves[(record["_id"]["category"], record["_id"]["bits"])] = record["count"]
+
+    from dissect.utils.telemetry import TIMEOUT_MESSAGE
+
+    results = {}
+    for trait in traits:
+        # Results stored before the status field was introduced are classified like in get_timed_out
+        legacy = {"$or": [{"$eq": [f"${field}", TIMEOUT_MESSAGE]} for field in _result_fields(trait)]}
+        # One grouped pass over each trait collection instead of a count per parameter combination
+        trait_pipeline = [
+            {"$match": format_trait_query(trait, query) if query else dict()},
+            {
+                "$group": {
+                    "_id": {
+                        "params": "$params",
+                        "category": "$curve.category",
+                        "bits": "$curve.bits",
+                        "status": {
+                            "$ifNull": ["$status", {"$cond": [legacy, "timeout", "ok"]}]
+                        },
+                    },
+                    "count": {"$sum": 1},
+                }
+            },
+        ]
+        for record in db[f"trait_{trait}"].aggregate(trait_pipeline, allowDiskUse=True):
+            group = record["_id"]
+            key = (trait, _params_key(group["params"]), group["category"], group["bits"], group["status"])
+            results[key] = results.get(key, 0) + record["count"]
+    return curves, results
+
+
+def create_run(
+    db: Database,
+    traits: List[str],
+    query: Dict[str, Any],
+    jobs: Iterable[Dict[str, Any]],
+    batch_size: int = 10000,
+    retry: bool = False,
+) -> str:
+    run_id = uuid.uuid4().hex[:12]
+    db["jobs"].create_index([("run", 1), ("index", 1)], unique=True)
+    db["jobs"].create_index([("run", 1), ("status", 1), ("index", 1)])
+    db["jobs"].create_index([("lease.owner", 1), ("status", 1)])
+
+    count = 0
+    jobs = iter(jobs)
+    while True:
+        batch = [
+            dict(job, run=run_id, index=index, status="pending")
+            for index, job in enumerate(itertools.islice(jobs, batch_size), count)
+        ]
+        if not batch:
+            break
+        db["jobs"].insert_many(_cast_sage_types(batch), ordered=False)
+        count += len(batch)
+
+    db["runs"].insert_one(
+        {
+            "_id": run_id,
+            "traits": traits,
+            "query": query,
+            "jobs": count,
+            "watermark": 0,
+            "done": [],
+            "status": "running",
+            "retry": retry,
+            "created": datetime.datetime.now(datetime.timezone.utc),
+        }
+    )
+    return run_id
+
+
+def get_run(db: Database, run_id: str) -> Optional[Dict[str, Any]]:
+    run = db["runs"].find_one({"_id": run_id})
+    if run is not None:
+        run["done"] = set(
+            index for start, stop in run["done"] for index in range(start, stop)
+        )
+    return run
+
+
+def get_jobs(
+    db: Database, run: Dict[str, Any], batch_size: int = 1000
+) -> Iterable[Dict[str, Any]]:
+    cursor = (
+        db["jobs"]
+        .find(
+            {
+                "run": run["_id"],
+                "index": {"$gte": run["watermark"]},
+                "status": {"$ne": "done"},
+            },
+            {"_id": 0},
+            batch_size=batch_size,
+        )
+        .sort("index", 1)
+    )
+    return filter(lambda job: job["index"] not in run["done"], cursor)
+
+
+def store_run_progress(
+    db: Database, run_id: str, watermark: int, done: Iterable[int], finished: bool = False
+) -> None:
+    # Indices above the watermark are stored as [start, stop) ranges
+    ranges = []
+    for index in sorted(done):
+        if ranges and ranges[-1][1] == index:
+            ranges[-1][1] = index + 1
+        else:
+            ranges.append([index, index + 1])
+    db["runs"].update_one(
+        {"_id": run_id},
+        {
+            "$set": {
+                "watermark": watermark,
+                "done": ranges,
+                "status": "finished" if finished else "running",
+                "updated": datetime.datetime.now(datetime.timezone.utc),
+            }
+        },
+    )
+
+
+def claim_jobs(
+    db: Database, run_id: str, owner: str, count: int, lease: float
+) -> List[Dict[str, Any]]:
+    # Pending jobs and jobs whose lease expired (e.g. their worker died) can be claimed
+    jobs = []
+    for _ in range(count):
+        now = datetime.datetime.now(datetime.timezone.utc)
+        job = db["jobs"].find_one_and_update(
+            {
+                "run": run_id,
+                "$or": [
+                    {"status": "pending"},
+                    {"status": "leased", "lease.expires": {"$lt": now}},
+                ],
+            },
+            {
+                "$set": {
+                    "status": "leased",
+                    "lease": {
+                        "owner": owner,
+                        "expires": now + datetime.timedelta(seconds=lease),
+                    },
+                },
+                "$inc": {"attempts": 1},
+            },
+            projection={"_id": 0},
+            sort=[("index", 1)],
+            return_document=ReturnDocument.AFTER,
+        )
+        if job is None:
+            break
+        jobs.append(job)
+    return jobs
+
+
+def extend_leases(db: Database, owner: str, lease: float) -> int:
+    expires = datetime.datetime.now(datetime.timezone.utc) + datetime.timedelta(
+        seconds=lease
+    )
+    return sum(
+        db[collection].update_many(
+            {"lease.owner": owner, "status": "leased"},
+            {"$set": {"lease.expires": expires}},
+        ).modified_count
+        for collection in ("jobs", "requests")
+    )
+
+
+def complete_jobs(db: Database, run_id: str, indices: Iterable[int]) -> int:
+    return db["jobs"].update_many(
+        {"run": run_id, "index": {"$in": list(indices)}},
+        {"$set": {"status": "done"}, "$unset": {"lease": ""}},
+    ).modified_count
+
+
+def release_job(
+    db: Database,
+    run_id: str,
+    index: int,
+    abandoned: List[List[Any]] = None,
+    owner: str = None,
+) -> int:
+    # Puts a job of a killed worker back without waiting for its lease to expire, unless owner is given and
+    # the job was claimed by someone else meanwhile
+    update = {"$set": {"status": "pending"}, "$unset": {"lease": ""}}
+    if abandoned:
+        update["$set"]["abandoned"] = abandoned
+    match = {"run": run_id, "index": index, "status": "leased"}
+    if owner is not None:
+        match["lease.owner"] = owner
+    return db["jobs"].update_one(match, update).modified_count
+
+
+def create_requests(
+    db: Database, jobs: Iterable[Dict[str, Any]], priority: int = 1
+) -> List[str]:
+    # Requests are jobs outside of runs, claimed before any job of a run and by higher priority first
+    db["requests"].create_index(
+        [("status", 1), ("priority", -1), ("created", 1), ("cost", -1)]
+    )
+    db["requests"].create_index([("lease.owner", 1), ("status", 1)])
+    now = datetime.datetime.now(datetime.timezone.utc)
+    requests = [
+        dict(job, _id=uuid.uuid4().hex[:12], priority=priority, status="pending", created=now)
+        for job in jobs
+    ]
+    if requests:
+        db["requests"].insert_many(_cast_sage_types(requests))
+    return [request["_id"] for request in requests]
+
+
+def claim_request(db: Database, owner: str, lease: float) -> Optional[Dict[str, Any]]:
+    now = datetime.datetime.now(datetime.timezone.utc)
+    return db["requests"].find_one_and_update(
+        {
+            "$or": [
+                {"status": "pending"},
+                {"status": "leased", "lease.expires": {"$lt": now}},
+            ],
+        },
+        {
+            "$set": {
+                "status": "leased",
+                "lease": {
+                    "owner": owner,
+                    "expires": now + datetime.timedelta(seconds=lease),
+                },
+            },
+            "$inc": {"attempts": 1},
+        },
+        sort=[("priority", -1), ("created", 1), ("cost", -1)],
+        return_document=ReturnDocument.AFTER,
+    )
+
+
+def complete_requests(db: Database, request_ids: Iterable[str]) -> int:
+    return db["requests"].update_many(
+        {"_id": {"$in": list(request_ids)}},
+        {"$set": {"status": "done"}, "$unset": {"lease": ""}},
+    ).modified_count
+
+
+def release_request(
+    db: Database, request_id: str, abandoned: List[List[Any]] = None, owner: str = None
+) -> int:
+    update = {"$set": {"status": "pending"}, "$unset": {"lease": ""}}
+    if abandoned:
+        update["$set"]["abandoned"] = abandoned
+    match = {"_id": request_id, "status": "leased"}
+    if owner is not None:
+        match["lease.owner"] = owner
+    return db["requests"].update_one(match, update).modified_count
+
+
+def get_run_progress(db: Database, run_id: str) -> Tuple[int, int]:
+    """Returns the watermark (first index of an unfinished job) and the number of unfinished jobs"""
+    first = db["jobs"].find_one(
+        {"run": run_id, "status": {"$ne": "done"}},
+        {"_id": 0, "index": 1},
+        sort=[("index", 1)],
+    )
+    if first is None:
+        return db["runs"].find_one({"_id": run_id})["jobs"], 0
+    remaining = db["jobs"].count_documents({"run": run_id, "status": {"$ne": "done"}})
+    return first["index"], remaining
+
+
+def _params_key(params: Dict[str, Any]) -> Tuple[Tuple[str, Any], ...]:
+    return tuple(sorted(_cast_sage_types(dict(params)).items()))
+
+
+def get_unsolved(
+    db: Database,
+    traits: Iterable[str],
+    query: Any = None,
+    batch_size: int = 1000,
+) -> Iterable[Tuple[Dict[str, Any], List[Tuple[str, Dict[str, Any]]]]]:
+    # Set difference of curves and stored results computed in chunked $in batches
+    tasks = [(trait, params) for trait in traits for params in TRAITS[trait].params_iter()]
+
+    cursor = db["curves"].find(
+        format_curve_query(query) if query else dict(),
+        {"_id": 0},
+        batch_size=batch_size,
+    )
+    while True:
+        curves = list(itertools.islice(cursor, batch_size))
+        if not curves:
+            return
+
+        solved = set()
+        names = [curve["name"] for curve in curves]
+        for trait in set(trait for trait, _ in tasks):
+            for record in db[f"trait_{trait}"].find(
+                {"curve.name": {"$in": names}},
+                {"_id": 0, "curve.name": 1, "params": 1},
+            ):
+                solved.add(
+                    (trait, record["curve"]["name"], _params_key(record["params"]))
+                )
+
+        for curve in curves:
+            missing = [
+                (trait, params)
+                for trait, params in tasks
+                if (trait, curve["name"], _params_key(params)) not in solved
+            ]
+            if missing:
+                yield _decode_ints(curve), missing
+
+
+def _result_fields(trait: str) -> List[str]:
+    """Fields of the stored results of the trait"""
+    return [f"result.{key}" for key in TRAITS[trait].OUTPUT]
+
+
+def get_timed_out(
+    db: Database,
+    traits: Iterable[str],
+    query: Any = None,
+    max_tier: int = 0,
+) -> Iterable[Tuple[Dict[str, Any], str, Dict[str, Any], int]]:
+    """Yields (curve, trait, params, tier) of timed out results computed with tier at most max_tier"""
+    from dissect.utils.telemetry import TIMEOUT_MESSAGE
+
+    for trait in traits:
+        match = format_trait_query(trait, query) if query else dict()
+        # Results stored before the status field was introduced are recognized by the timeout message
+        legacy = [{field: TIMEOUT_MESSAGE} for field in _result_fields(trait)]
+        match["$or"] = [
+            {"status": "timeout", "tier": {"$lte": max_tier}},
+            {"status": {"$exists": False}, "$or": legacy},
+        ]
+        for record in db[f"trait_{trait}"].find(
+            match, {"_id": 0, "curve": 1, "params": 1, "tier": 1}
+        ):
+            yield record["curve"], trait, record["params"], record.get("tier", 0)
 
 
 def get_trait_results(
-    db: Database, trait: str, query: Dict[str, Any] = None, limit: int = None
+    db: Database,
+    trait: str,
+    query: Dict[str, Any] = None,
+    limit: int = None,
+    skip_failed: bool = False,
 ):
     aggregate_pipeline = []
-    aggregate_pipeline.append(
-        {"$match": format_trait_query(trait, query) if query else dict()}
-    )
+    match = format_trait_query(trait, query) if query else dict()
+    if skip_failed:
+        match["status"] = {"$nin": ["timeout", "failed"]}
+    aggregate_pipeline.append({"$match": match})
     aggregate_pipeline.append({"$unset": "_id"})
     if limit:
         aggregate_pipeline.append({"$limit": limit})
@@ -407,6 +839,10 @@ def main():
     parser_import = subparsers.add_parser("import")
     parser_import.add_argument("-i", "--input", type=str, default="dissect.tar")
 
+    parser_report = subparsers.add_parser("report")
+    parser_report.add_argument("--trait", type=str, default=["all"], nargs="*")
+    parser_report.add_argument("--bits", type=str, default=["all"], nargs="*")
+
     args = parser.parse_args()
 
     db = connect(args.database_url)
@@ -495,6 +931,111 @@ def main():
             else:
                 print("Unknown input format")
 
+        elif args.command == "report":
+            print(
+                f"{'trait':<22}{'params':<16}{'bits':>6}{'count':>9}{'hours':>10}"
+                f"{'mean s':>10}{'max s':>10}{'cpu h':>10}{'rss MiB':>9}{'timeouts':>10}{'failures':>10}"
+            )
+            for r in get_telemetry_report(db, vars(args)):
+                params = ",".join(f"{k}={v}" for k, v in r["params"].items())
+                print(
+                    f"{r['trait']:<22}{params:<16}{r['bits']:>6}{r['count']:>9}"
+                    f"{r['wall'] / 3600:>10.3f}{r['wall'] / r['count']:>10.3f}{r['wall_max']:>10.3f}"
+                    f"{r['cpu'] / 3600:>10.3f}{(r['rss_max'] or 0) / 2**20:>9.0f}"
+                    f"{r['timeouts']:>10}{r['failures']:>10}"
+                )
+
+
+def _test_database():
+    """A scratch database on the server given by DISSECT_TEST_DATABASE (a local mongod by default), the test is
+    skipped when there is none"""
+    import pytest
+    from pymongo.errors import PyMongoError
+
+    client = MongoClient(
+        os.environ.get("DISSECT_TEST_DATABASE", "mongodb://localhost:27017/"),
+        serverSelectionTimeoutMS=500,
+    )
+    try:
+        client.admin.command("ping")
+    except PyMongoError:
+        pytest.skip("no MongoDB server available")
+    name = f"dissect_test_{uuid.uuid4().hex[:8]}"
+    return client, client[name]
+
+
+def test_claim_jobs():
+    client, db = _test_database()
+    try:
+        run_id = create_run(db, ["cofactor"], {}, ({"curve": f"c{i}", "tasks": []} for i in range(3)))
+        first = claim_jobs(db, run_id, "a", 2, 60)
+        assert [job["index"] for job in first] == [0, 1]
+        assert all(job["lease"]["owner"] == "a" and job["attempts"] == 1 for job in first)
+        assert [job["index"] for job in claim_jobs(db, run_id, "b", 2, 60)] == [2]
+        assert claim_jobs(db, run_id, "b", 2, 60) == []
+    finally:
+        client.drop_database(db.name)
+
+
+def test_expired_lease_is_claimed_again():
+    client, db = _test_database()
+    try:
+        run_id = create_run(db, ["cofactor"], {}, [{"curve": "c", "tasks": []}])
+        assert len(claim_jobs(db, run_id, "a", 1, -1)) == 1
+        again = claim_jobs(db, run_id, "b", 1, 60)
+        assert again[0]["lease"]["owner"] == "b" and again[0]["attempts"] == 2
+        # The lost worker cannot release a job claimed by another one
+        assert release_job(db, run_id, 0, owner="a") == 0
+        assert release_job(db, run_id, 0, owner="b") == 1
+        assert claim_jobs(db, run_id, "a", 1, 60)[0]["attempts"] == 3
+    finally:
+        client.drop_database(db.name)
+
+
+def test_extend_leases():
+    client, db = _test_database()
+    try:
+        run_id = create_run(db, ["cofactor"], {}, ({"curve": f"c{i}", "tasks": []} for i in range(3)))
+        claim_jobs(db, run_id, "a", 2, 1)
+        claim_jobs(db, run_id, "b", 1, 1)
+        assert extend_leases(db, "a", 600) == 2
+        expires = [job["lease"]["expires"] for job in db["jobs"].find({"lease.owner": "a"})]
+        soon = datetime.datetime.now(datetime.timezone.utc).replace(tzinfo=None) + datetime.timedelta(seconds=300)
+        assert all(e > soon for e in expires)
+        complete_jobs(db, run_id, [0])
+        assert extend_leases(db, "a", 600) == 1
+    finally:
+        client.drop_database(db.name)
+
+
+def test_complete_jobs():
+    client, db = _test_database()
+    try:
+        run_id = create_run(db, ["cofactor"], {}, ({"curve": f"c{i}", "tasks": []} for i in range(4)))
+        claim_jobs(db, run_id, "a", 4, 60)
+        assert complete_jobs(db, run_id, [0, 2]) == 2
+        assert get_run_progress(db, run_id) == (1, 2)
+        assert db["jobs"].find_one({"run": run_id, "index": 0}).get("lease") is None
+        complete_jobs(db, run_id, [1, 3])
+        assert get_run_progress(db, run_id) == (4, 0)
+    finally:
+        client.drop_database(db.name)
+
+
+def test_store_run_progress():
+    client, db = _test_database()
+    try:
+        run_id = create_run(db, ["cofactor"], {}, ({"curve": f"c{i}", "tasks": []} for i in range(8)))
+        store_run_progress(db, run_id, 2, [3, 4, 6])
+        run = get_run(db, run_id)
+        assert run["watermark"] == 2 and run["done"] == {3, 4, 6}
+        assert db["runs"].find_one({"_id": run_id})["done"] == [[3, 5], [6, 7]]
+        assert [job["index"] for job in get_jobs(db, run)] == [2, 5, 7]
+        store_run_progress(db, run_id, 8, [], finished=True)
+        assert get_run(db, run_id)["status"] == "finished"
+    finally:
+        client.drop_database(db.name)
+
 
 if __name__ == "__main__":
     main()
@@ -0,0 +1,77 @@
+from collections import OrderedDict
+
+from sage.all import EllipticCurve
+
+EXTENDED_CURVES_SIZE = 4
+
+
+class ExtensionTower:
+    """Traces and cardinalities of a curve over the extensions of its field, memoized for every degree up to the
+    largest one requested, and a bounded LRU of the curve base extended to them"""
+
+    __slots__ = ("_curve", "_traces", "_curves", "_size")
+
+    def __init__(self, curve, size=EXTENDED_CURVES_SIZE):
+        self._curve = curve
+        self._traces = [2, curve.trace()]
+        self._curves = OrderedDict()
+        self._size = size
+
+    def trace(self, deg):
+        """Trace of Frobenius over the deg-th relative extension, t_deg = t * t_(deg-1) - q * t_(deg-2)"""
+        q, t = self._curve.q(), self._traces[1]
+        while len(self._traces) <= deg:
+            self._traces.append(t * self._traces[-1] - q * self._traces[-2])
+        return self._traces[deg]
+
+    def cardinality(self, deg):
+        return self._curve.q() ** deg + 1 - self.trace(deg)
+
+    def frobenius_disc(self, deg=1):
+        return self.trace(deg) ** 2 - 4 * self._curve.q() ** deg
+
+    def curve(self, deg):
+        """The curve over the deg-th relative extension, with its order set"""
+        ext_ec = self._curves.pop(deg, None)
+        if ext_ec is None:
+            ext_ec = self._extend(deg)
+        self._curves[deg] = ext_ec
+        if len(self._curves) > self._size:
+            self._curves.popitem(last=False)
+        return ext_ec
+
+    def _extend(self, deg):
+        ext_field, embedding = self._curve.context().extension(deg)
+        ec = self._curve.ec()
+        if self._curve.is_over_prime():
+            ext_ec = ec.base_extend(ext_field)
+        else:
+            ext_ec = EllipticCurve(ext_field, [embedding(a) for a in ec.a_invariants()])
+        ext_ec.set_order(self.cardinality(deg), num_checks=0)
+        return ext_ec
+
+
+class _Curve:
+    """Stands in for a curve in tests of the functions of its trace and field order only"""
+
+    def __init__(self, trace, q):
+        self._trace = trace
+        self._q = q
+
+    def trace(self):
+        return self._trace
+
+    def q(self):
+        return self._q
+
+
+def test_trace_recurrence():
+    # Frobenius of y^2 = x^3 + x over F_5 has trace 2, its eigenvalues are 1 + 2i and 1 - 2i
+    tower = ExtensionTower(_Curve(2, 5))
+    roots = (complex(1, 2), complex(1, -2))
+    for deg in range(1, 8):
+        assert tower.trace(deg) == round((roots[0] ** deg + roots[1] ** deg).real)
+    assert tower.trace(0) == 2
+    assert tower.cardinality(1) == 4
+    assert tower.cardinality(2) == 5**2 + 1 - tower.trace(2)
+    assert tower.frobenius_disc() == -16
@@ -0,0 +1,118 @@
+import json
+import os
+import socket
+import sqlite3
+import tempfile
+from collections import OrderedDict
+
+LRU_SIZE = 4096
+# Smaller integers factor faster than a disk lookup pays off, they are kept in memory only
+DISK_MIN_BITS = 64
+# SQLite in WAL mode needs a local filesystem, home directories of cluster nodes are often mounted over the
+# network, so the default file is in the temporary directory and named after the host
+DEFAULT_PATH = os.path.join(
+    tempfile.gettempdir(), f"dissect-{os.getuid()}", f"factors-{socket.gethostname()}.sqlite"
+)
+
+
+class FactorCache:
+    """Factorizations keyed by the absolute value of the integer, in an in-process LRU in front of SQLite
+
+    A record is (factors, composites, budget, effort): the known prime factors with exponents, the composite
+    parts left unfactored (none if the factorization is complete), the largest time budget that was not
+    enough to finish it and the work done so far by the staged factorization. Records are shared by all
+    traits, processes and runs using the same file, which must be on a local disk of the host.
+    """
+
+    def __init__(self, path=DEFAULT_PATH, size=LRU_SIZE):
+        self._path = path
+        self._size = size
+        self._memory = OrderedDict()
+        self._connection = None
+        self._pid = None
+
+    def persistent(self):
+        """Whether records of at least DISK_MIN_BITS bits are stored on disk and shared with other processes"""
+        return bool(self._path)
+
+    def _db(self):
+        if not self._path:
+            return None
+        # Connections must not be shared with forked children
+        if self._pid != os.getpid():
+            os.makedirs(os.path.dirname(os.path.abspath(self._path)), exist_ok=True)
+            self._connection = sqlite3.connect(self._path, timeout=30)
+            self._connection.execute("PRAGMA journal_mode=WAL")
+            self._connection.execute(
+                "CREATE TABLE IF NOT EXISTS factors"
+                " (value TEXT PRIMARY KEY, factors TEXT, composites TEXT, budget REAL, effort TEXT)"
+            )
+            self._pid = os.getpid()
+        return self._connection
+
+    def _remember(self, key, record):
+        self._memory[key] = record
+        self._memory.move_to_end(key)
+        if len(self._memory) > self._size:
+            self._memory.popitem(last=False)
+
+    def get(self, value):
+        """Returns ([(p, e), ...], [composite, ...], budget, effort) with Python integers, or None"""
+        key = abs(int(value))
+        if key in self._memory:
+            self._memory.move_to_end(key)
+            return self._memory[key]
+        if key.bit_length() < DISK_MIN_BITS or self._db() is None:
+            return None
+        try:
+            row = self._db().execute(
+                "SELECT factors, composites, budget, effort FROM factors WHERE value = ?",
+                (hex(key),),
+            ).fetchone()
+        except sqlite3.Error:
+            return None
+        if row is None:
+            return None
+        record = (
+            [(int(p, 16), e) for p, e in json.loads(row[0])],
+            [int(c, 16) for c in json.loads(row[1])],
+            row[2],
+            json.loads(row[3]) if row[3] else {},
+        )
+        self._remember(key, record)
+        return record
+
+    def put(self, value, factors, composites=(), budget=None, effort=None):
+        """Records known factors of the value; an incomplete record keeps the largest budget that was tried"""
+        key = abs(int(value))
+        factors = sorted((int(p), int(e)) for p, e in factors)
+        composites = sorted(int(c) for c in composites)
+        effort = dict(effort or {})
+        previous = self.get(key)
+        if previous is not None:
+            if not previous[1]:
+                return
+            if composites:
+                budget = max(budget or 0, previous[2] or 0)
+        record = (factors, composites, budget if composites else None, effort)
+        self._remember(key, record)
+        if key.bit_length() < DISK_MIN_BITS or self._db() is None:
+            return
+        try:
+            with self._db() as connection:
+                connection.execute(
+                    "INSERT OR REPLACE INTO factors VALUES (?, ?, ?, ?, ?)",
+                    (
+                        hex(key),
+                        json.dumps([(hex(p), e) for p, e in record[0]]),
+                        json.dumps([hex(c) for c in record[1]]),
+                        record[2],
+                        json.dumps(record[3]),
+                    ),
+                )
+        except sqlite3.Error:
+            # The cache is an optimization, a locked or read-only file must not fail the computation
+            pass
+
+
+FACTOR_CACHE = FactorCache(os.environ.get("DISSECT_FACTOR_CACHE", DEFAULT_PATH))
@@ -0,0 +1,136 @@
+from collections import OrderedDict
+from functools import lru_cache
+
+from sage.all import GF, ZZ, PolynomialRing
+
+from dissect.utils.curve_form import dict_to_poly
+from dissect.utils.kohel.modular_polynomials import modular_polynomials
+
+FIELD_CONTEXTS_SIZE = 32
+# Polynomial rings over the fields of small primes used by traits, e.g. in eigenvalues of Frobenius
+SMALL_FIELD_RINGS_SIZE = 256
+# Extension fields held per context, large degrees take a lot of memory
+EXTENSIONS_SIZE = 8
+
+
+def field_key(field_dict):
+    """(characteristic, degree, modulus) identifying the field of a database record"""
+    if field_dict["type"] == "Prime":
+        return ZZ(field_dict["p"]), 1, None
+    base = 2 if field_dict["type"] == "Binary" else ZZ(field_dict["base"])
+    modulus = tuple(sorted((int(mono["power"]), int(ZZ(mono["coeff"]))) for mono in field_dict["poly"]))
+    return ZZ(base), int(field_dict["degree"]), modulus
+
+
+@lru_cache(maxsize=None)
+def integer_modular_polynomial(level):
+    return modular_polynomials(level)
+
+
+@lru_cache(maxsize=SMALL_FIELD_RINGS_SIZE)
+def small_field_polynomial_ring(prime, degree=1):
+    """Polynomial ring over F_(prime^degree) for the small primes of traits, cached apart from the contexts of the
+    fields of curves so that they do not evict them"""
+    return PolynomialRing(GF(prime**degree, "a", proof=False), "x")
+
+
+class FieldContext:
+    """Sage objects derived from one base field, constructed once and shared by all curves over it: the field,
+    polynomial rings, extension fields with the embedding of the base field and constants reduced to the field"""
+
+    def __init__(self, characteristic, degree, modulus=None):
+        self._characteristic = characteristic
+        self._degree = degree
+        self._modulus = modulus
+        self._field = None
+        self._rings = {}
+        self._extensions = OrderedDict()
+        self._modular_polynomials = {}
+
+    def q(self):
+        return self._characteristic**self._degree
+
+    def prime_field(self):
+        return GF(self._characteristic, proof=False)
+
+    def field(self):
+        if self._field is None:
+            if self._degree == 1:
+                self._field = GF(self._characteristic, proof=False)
+            elif self._modulus is None:
+                self._field = GF(self.q(), proof=False)
+            else:
+                modulus = dict_to_poly(
+                    [{"power": power, "coeff": coeff} for power, coeff in self._modulus],
+                    self.prime_field()["w"],
+                )
+                self._field = GF(self.q(), "w", modulus, proof=False)
+        return self._field
+
+    def polynomial_ring(self, name="x"):
+        if name not in self._rings:
+            self._rings[name] = PolynomialRing(self.field(), name)
+        return self._rings[name]
+
+    def extension(self, deg):
+        """Returns the extension field of relative degree deg and the embedding of the field into it"""
+        if deg in self._extensions:
+            self._extensions.move_to_end(deg)
+        else:
+            extension = GF(
+                self.q() ** deg,
+                name="z",
+                modulus=self.prime_field()["z"].irreducible_element(deg * self._degree),
+            )
+            if self._degree == 1:
+                embedding = extension
+            else:
+                # The image of the generator is a root of its minimal polynomial in the extension
+                root = self.field().modulus().change_ring(extension).roots(multiplicities=False)[0]
+                embedding = self.field().hom([root], extension)
+            self._extensions[deg] = extension, embedding
+            if len(self._extensions) > EXTENSIONS_SIZE:
+                self._extensions.popitem(last=False)
+        return self._extensions[deg]
+
+    def modular_polynomial(self, level):
+        """The classical modular polynomial of the given level with coefficients reduced to the field"""
+        if level not in self._modular_polynomials:
+            self._modular_polynomials[level] = integer_modular_polynomial(level).change_ring(self.field())
+        return self._modular_polynomials[level]
+
+
+class FieldContextCache:
+    """Bounded LRU of field contexts keyed by (characteristic, degree, modulus)"""
+
+    def __init__(self, size=FIELD_CONTEXTS_SIZE):
+        self._size = size
+        self._contexts = OrderedDict()
+
+    def get(self, characteristic, degree=1, modulus=None):
+        key = (ZZ(characteristic), int(degree), modulus)
+        context = self._contexts.pop(key, None)
+        if context is None:
+            context = FieldContext(*key)
+        self._contexts[key] = context
+        if len(self._contexts) > self._size:
+            self._contexts.popitem(last=False)
+        return context
+
+
+FIELD_CONTEXTS = FieldContextCache()
+
+
+def test_field_key():
+    assert field_key({"type": "Prime", "p": "0x17"}) == (23, 1, None)
+    binary = {
+        "type": "Binary",
+        "degree": 5,
+        "poly": [{"power": 5, "coeff": 1}, {"power": 0, "coeff": 1}, {"power": 2, "coeff": 1}],
+    }
+    assert field_key(binary) == (2, 5, ((0, 1), (2, 1), (5, 1)))
+    # The order of the monomials does not change the key
+    binary["poly"].reverse()
+    assert field_key(binary) == (2, 5, ((0, 1), (2, 1), (5, 1)))
+    extension = {"type": "Extension", "base": "0x7", "degree": "2", "poly": [{"power": 2, "coeff": 1}]}
+    assert field_key(extension) == (7, 2, ((2, 1),))
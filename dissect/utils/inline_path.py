@@ -0,0 +1,136 @@
+import threading
+import time
+from collections import deque
+
+from cysignals.alarm import AlarmInterrupt, alarm, cancel_alarm
+
+from dissect.utils.telemetry import TIMEOUT_MESSAGE
+from dissect.utils.timeout_pool import FAILURE_MESSAGE, UNAVAILABLE
+
+# A timed call runs in the calling process while the last INLINE_MIN_SAMPLES calls of the same function on inputs
+# of the same size all finished within INLINE_MAX_SECONDS
+INLINE_MAX_SECONDS = 0.01
+INLINE_MIN_SAMPLES = 3
+# Inputs are grouped by the bit length of their largest integer, in buckets of this width
+INLINE_BUCKET_BITS = 8
+# An inline call is interrupted after this multiple of the slowest observed duration and sandboxed instead
+INLINE_GUARD_FACTOR = 10
+
+
+def input_bits(args):
+    """Bit length of the largest integer among the arguments, None if some argument is not an integer"""
+    bits = 0
+    for x in args:
+        if isinstance(x, (list, tuple)):
+            size = input_bits(x)
+        elif isinstance(x, int):
+            size = x.bit_length()
+        elif hasattr(x, "nbits"):
+            size = x.nbits()
+        elif hasattr(x, "modulus") and hasattr(x, "lift"):
+            # Element of Integers(n)
+            size = x.modulus().nbits()
+        else:
+            return None
+        if size is None:
+            return None
+        bits = max(bits, size)
+    return bits
+
+
+class InlinePredictor:
+    """Predicts from the history of timed calls in this process which ones are cheap enough to run inline
+
+    A call is only predicted cheap while the last calls of the same function on inputs of the same bit length
+    finished quickly in the sandbox. Inputs of unknown size, functions that ever timed out or failed, functions
+    registered with sandbox_always and nested calls are always sandboxed, and an inline call runs under an alarm, so that a wrong prediction
+    costs at most a few times the expected duration before the call is sandboxed after all.
+    """
+
+    def __init__(self):
+        self._history = {}
+        self._risky = set()
+        self._sandboxed = set()
+        self._active = False
+
+    def key(self, func, args, kwargs):
+        name = getattr(func, "__qualname__", None)
+        bits = input_bits(list(args) + list(kwargs.values()))
+        if name is None or bits is None:
+            return None
+        return getattr(func, "__module__", None), name, bits // INLINE_BUCKET_BITS
+
+    def sandbox_always(self, func):
+        """Never runs func inline, e.g. because it starts subprocesses that an alarm would leave running"""
+        self._sandboxed.add((getattr(func, "__module__", None), func.__qualname__))
+        return func
+
+    def guard(self, key, timeout_duration):
+        """Seconds after which an inline call is interrupted, None if the call must be sandboxed"""
+        if key is None or key in self._risky or key[:2] in self._sandboxed or self._active:
+            return None
+        # Alarms are delivered to the main thread only
+        if threading.current_thread() is not threading.main_thread():
+            return None
+        recent = self._history.get(key, ())
+        if len(recent) < INLINE_MIN_SAMPLES or max(recent) > INLINE_MAX_SECONDS:
+            return None
+        return min(timeout_duration, max(INLINE_GUARD_FACTOR * max(recent), INLINE_MAX_SECONDS))
+
+    def observe(self, key, seconds, result):
+        if key is None:
+            return
+        if isinstance(result, str) and result in (TIMEOUT_MESSAGE, FAILURE_MESSAGE):
+            self.reject(key)
+            return
+        self._history.setdefault(key, deque(maxlen=INLINE_MIN_SAMPLES)).append(seconds)
+
+    def reject(self, key):
+        """Sandboxes the calls of this key from now on"""
+        self._risky.add(key)
+        self._history.pop(key, None)
+
+    def run(self, func, args, kwargs, guard):
+        """Runs func in this process, returns UNAVAILABLE if it did not finish within guard seconds"""
+        self._active = True
+        try:
+            try:
+                alarm(guard)
+                try:
+                    return func(*args, **kwargs)
+                finally:
+                    cancel_alarm()
+            except AlarmInterrupt:
+                return UNAVAILABLE
+            except Exception:
+                # Like in the sandbox, a computation raising an error has no result
+                return FAILURE_MESSAGE
+        finally:
+            self._active = False
+
+    def call(self, func, args, kwargs, timeout_duration, sandboxed):
+        """Runs func inline when predicted cheap, otherwise (or if the prediction fails) by calling sandboxed with
+        the rest of timeout_duration, learning from the duration of the sandboxed call"""
+        key = self.key(func, args, kwargs)
+        guard = self.guard(key, timeout_duration)
+        if guard is not None:
+            start = time.monotonic()
+            result = self.run(func, args, kwargs, guard)
+            seconds = time.monotonic() - start
+            failed = isinstance(result, str) and result == FAILURE_MESSAGE
+            if result is not UNAVAILABLE and not failed:
+                self.observe(key, seconds, result)
+                return result
+            self.reject(key)
+            timeout_duration -= seconds
+            if timeout_duration <= 0:
+                return TIMEOUT_MESSAGE
+
+        start = time.monotonic()
+        result = sandboxed(timeout_duration)
+        if result is not UNAVAILABLE:
+            self.observe(key, time.monotonic() - start, result)
+        return result
+
+
+INLINE_PREDICTOR = InlinePredictor()
@@ -0,0 +1,79 @@
+from multiprocessing import Array, Condition
+
+
+class MemoryBudget:
+    """Memory of a node shared by its worker processes, each reserves the expected footprint of its job
+
+    Reservations are kept per worker identifier, so that the reservation of a killed worker is dropped
+    by resetting its slot when the worker is replaced.
+    """
+
+    def __init__(self, total, workers):
+        self._total = total
+        self._reserved = Array("d", workers + 1)
+        self._condition = Condition(self._reserved.get_lock())
+
+    def acquire(self, identifier, mib, block=True):
+        # A job larger than the whole budget runs alone instead of never
+        mib = min(mib, self._total)
+        with self._condition:
+            reserved = self._reserved.get_obj()
+            reserved[identifier] = 0.0
+            while self._total - sum(reserved) < mib:
+                if not block:
+                    return False
+                self._condition.wait()
+            reserved[identifier] = mib
+        return True
+
+    def release(self, identifier):
+        with self._condition:
+            self._reserved.get_obj()[identifier] = 0.0
+            self._condition.notify_all()
+
+
+class CoreBudget:
+    """Cores of a node beyond the one of each worker process, lent to workers racing factorization strategies
+
+    Loans are kept per worker identifier like the reservations of the memory budget, so that the cores lent to
+    a killed worker are returned when the worker is replaced.
+    """
+
+    def __init__(self, spare, workers):
+        self._spare = spare
+        self._lent = Array("i", workers + 1)
+
+    def take(self, identifier, cores):
+        """Lends up to the given number of cores without waiting, returns how many were lent"""
+        with self._lent.get_lock():
+            lent = self._lent.get_obj()
+            granted = max(min(cores, self._spare - sum(lent)), 0)
+            lent[identifier] += granted
+        return granted
+
+    def give(self, identifier):
+        with self._lent.get_lock():
+            self._lent.get_obj()[identifier] = 0
+
+
+def test_memory_budget():
+    budget = MemoryBudget(1000.0, 2)
+    assert budget.acquire(1, 600.0, block=False)
+    assert not budget.acquire(2, 600.0, block=False)
+    assert budget.acquire(2, 400.0, block=False)
+    # A new reservation of a worker replaces its previous one
+    assert budget.acquire(1, 500.0, block=False)
+    budget.release(2)
+    # A job larger than the whole budget runs alone
+    assert not budget.acquire(2, 2000.0, block=False)
+    budget.release(1)
+    assert budget.acquire(2, 2000.0, block=False)
+
+
+def test_core_budget():
+    cores = CoreBudget(3, 2)
+    assert cores.take(1, 2) == 2
+    assert cores.take(2, 2) == 1
+    assert cores.take(2, 1) == 0
+    cores.give(1)
+    assert cores.take(2, 5) == 2
@@ -0,0 +1,239 @@
+import collections
+import os
+import threading
+import time
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from queue import Empty
+
+RATE_WINDOW = 60
+STATS_INTERVAL = 10
+# Progress of a run polled from the database is sparse, its rate is taken over a longer window
+PROGRESS_WINDOW = 600
+
+
+class Metrics:
+    """Aggregates events sent by workers through a queue and exposes them in Prometheus text format
+
+    The jobs left and the ETA are counted from the finished jobs out of the given number of jobs, or follow
+    the remaining jobs reported through progress, e.g. by polling a run computed by several hosts.
+    """
+
+    def __init__(self, events, jobs=0, queue=None):
+        self._events = events
+        self._queue = queue
+        self._jobs = jobs
+        self._lock = threading.Lock()
+        self._started = time.monotonic()
+        self._tasks = collections.Counter()
+        self._task_seconds = collections.Counter()
+        self._recent_tasks = collections.deque()
+        self._recent_jobs = collections.deque()
+        self._jobs_done = 0
+        self._progress = collections.deque()
+        self._workers = {}
+        self._writes = 0
+        self._write_seconds = 0.0
+        self._write_last = 0.0
+        self._stop = threading.Event()
+        self._server = None
+        self._threads = []
+        if events is not None:
+            self._threads.append(threading.Thread(target=self._collect, daemon=True))
+
+    def serve(self, port):
+        metrics = self
+
+        class Handler(BaseHTTPRequestHandler):
+            def do_GET(self):
+                body = metrics.render().encode()
+                self.send_response(200)
+                self.send_header("Content-Type", "text/plain; version=0.0.4")
+                self.send_header("Content-Length", str(len(body)))
+                self.end_headers()
+                self.wfile.write(body)
+
+            def log_message(self, *args):
+                pass
+
+        self._server = ThreadingHTTPServer(("127.0.0.1", port), Handler)
+        self._server.daemon_threads = True
+        self._threads.append(
+            threading.Thread(target=self._server.serve_forever, daemon=True)
+        )
+        return self
+
+    def write_to(self, path, interval=STATS_INTERVAL):
+        def rewrite():
+            while not self._stop.wait(interval):
+                self._write_file(path)
+            self._write_file(path)
+
+        self._threads.append(threading.Thread(target=rewrite, daemon=True))
+        return self
+
+    def progress(self, remaining):
+        """Records the number of jobs left in the run"""
+        now = time.monotonic()
+        with self._lock:
+            self._progress.append((now, remaining))
+            while len(self._progress) > 2 and self._progress[0][0] < now - PROGRESS_WINDOW:
+                self._progress.popleft()
+
+    def start(self):
+        for thread in self._threads:
+            thread.start()
+        return self
+
+    def stop(self):
+        self._stop.set()
+        if self._server is not None:
+            self._server.shutdown()
+        for thread in self._threads:
+            thread.join()
+
+    def _write_file(self, path):
+        with open(f"{path}.tmp", "w") as f:
+            f.write(self.render())
+        # Atomic replace, so that readers never see a partially written file
+        os.replace(f"{path}.tmp", path)
+
+    def _collect(self):
+        while not self._stop.is_set():
+            try:
+                event = self._events.get(timeout=1)
+            except Empty:
+                continue
+            now = time.monotonic()
+            with self._lock:
+                kind, worker = event[0], event[1]
+                state = self._workers.setdefault(
+                    worker, {"since": now, "busy": 0.0, "started": None}
+                )
+                if kind == "start":
+                    state["started"] = now
+                elif kind == "task":
+                    _, _, trait, status, seconds = event
+                    self._tasks[(trait, status)] += 1
+                    self._task_seconds[trait] += seconds
+                    self._recent_tasks.append((now, trait, status))
+                elif kind == "finish":
+                    if state["started"] is not None:
+                        state["busy"] += now - state["started"]
+                    state["started"] = None
+                    self._jobs_done += 1
+                    self._recent_jobs.append(now)
+                elif kind == "write":
+                    _, _, seconds = event
+                    self._writes += 1
+                    self._write_seconds += seconds
+                    self._write_last = seconds
+                while self._recent_tasks and self._recent_tasks[0][0] < now - RATE_WINDOW:
+                    self._recent_tasks.popleft()
+                while self._recent_jobs and self._recent_jobs[0] < now - RATE_WINDOW:
+                    self._recent_jobs.popleft()
+
+    def render(self):
+        now = time.monotonic()
+        window = min(RATE_WINDOW, max(now - self._started, 1e-9))
+        lines = []
+
+        def metric(name, kind, help_text, samples):
+            lines.append(f"# HELP dissect_{name} {help_text}")
+            lines.append(f"# TYPE dissect_{name} {kind}")
+            for labels, value in samples:
+                label = ",".join(f'{k}="{v}"' for k, v in labels.items())
+                if label:
+                    lines.append(f"dissect_{name}{{{label}}} {value}")
+                else:
+                    lines.append(f"dissect_{name} {value}")
+
+        with self._lock:
+            recent = collections.Counter(trait for _, trait, _ in self._recent_tasks)
+            recent_timeouts = collections.Counter(
+                trait for _, trait, status in self._recent_tasks if status == "timeout"
+            )
+            traits = sorted(set(trait for trait, _ in self._tasks))
+            metric(
+                "tasks_total",
+                "counter",
+                "Computed trait tasks.",
+                [({"trait": t, "status": s}, n) for (t, s), n in sorted(self._tasks.items())],
+            )
+            metric(
+                "task_seconds_total",
+                "counter",
+                "Wall time spent computing trait tasks.",
+                [({"trait": t}, round(self._task_seconds[t], 3)) for t in traits],
+            )
+            metric(
+                "tasks_per_second",
+                "gauge",
+                f"Trait tasks finished per second over the last {RATE_WINDOW} s.",
+                [({"trait": t}, round(recent[t] / window, 3)) for t in traits],
+            )
+            metric(
+                "timeout_ratio",
+                "gauge",
+                f"Ratio of timed out trait tasks over the last {RATE_WINDOW} s.",
+                [
+                    ({"trait": t}, round(recent_timeouts[t] / recent[t], 3))
+                    for t in traits
+                    if recent[t]
+                ],
+            )
+            busy = []
+            for worker, state in sorted(self._workers.items()):
+                seconds = state["busy"]
+                if state["started"] is not None:
+                    seconds += now - state["started"]
+                busy.append(
+                    ({"worker": worker}, round(seconds / max(now - state["since"], 1e-9), 3))
+                )
+            metric(
+                "worker_busy_ratio",
+                "gauge",
+                "Fraction of time the worker was computing.",
+                busy,
+            )
+            metric(
+                "db_write_seconds",
+                "summary",
+                "Latency of bulk writes to the database.",
+                [],
+            )
+            lines.append(f"dissect_db_write_seconds_sum {round(self._write_seconds, 3)}")
+            lines.append(f"dissect_db_write_seconds_count {self._writes}")
+            metric(
+                "db_write_last_seconds",
+                "gauge",
+                "Latency of the last bulk write.",
+                [({}, round(self._write_last, 3))],
+            )
+            if self._queue is not None:
+                try:
+                    depth = self._queue.qsize()
+                except NotImplementedError:
+                    depth = -1
+                metric(
+                    "queue_depth",
+                    "gauge",
+                    "Jobs waiting in the local queue.",
+                    [({}, depth)],
+                )
+            metric("jobs_done", "counter", "Finished jobs.", [({}, self._jobs_done)])
+            if self._progress or self._jobs:
+                if self._progress:
+                    (first, most), (last, remaining) = self._progress[0], self._progress[-1]
+                    rate = (most - remaining) / (last - first) if last > first else 0
+                else:
+                    remaining = max(self._jobs - self._jobs_done, 0)
+                    rate = len(self._recent_jobs) / window
+                eta = round(remaining / rate) if rate > 0 else -1
+                metric("jobs_remaining", "gauge", "Jobs left in this run.", [({}, remaining)])
+                metric(
+                    "eta_seconds",
+                    "gauge",
+                    "Estimated time to finish the run at the recent job rate (-1 if unknown).",
+                    [({}, eta)],
+                )
+        return "\n".join(lines) + "\n"
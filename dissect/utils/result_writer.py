@@ -0,0 +1,331 @@
+import datetime
+import threading
+import time
+from typing import Any, Dict
+
+from pymongo import InsertOne, ReplaceOne
+from pymongo.errors import ServerSelectionTimeoutError
+
+from dissect.utils.database_handler import (
+    connect,
+    format_telemetry,
+    format_trait_result,
+    store_operations,
+)
+
+FLUSH_SIZE = 100
+FLUSH_AGE = 5.0
+CONNECTION_ATTEMPTS = 3
+# A batch that failed is kept and retried after RETRY_DELAY seconds, doubled after each consecutive failure,
+# and the writer gives up after FLUSH_RETRIES consecutive failures
+FLUSH_RETRIES = 6
+RETRY_DELAY = 1.0
+
+
+class ResultWriterError(RuntimeError):
+    """Raised by store and close once the writer gave up storing buffered results"""
+
+
+class ResultWriter:
+    """Buffers trait results of a worker and stores them in bulk on a background thread
+
+    Operations can be tagged, e.g. by the job they belong to. Once finish was called for a tag and all of its
+    operations are stored, the tag is passed to on_flush. If the writer gives up, the tags not passed to on_flush
+    are passed to on_fail.
+    """
+
+    def __init__(
+        self,
+        database,
+        flush_size=FLUSH_SIZE,
+        flush_age=FLUSH_AGE,
+        on_flush=None,
+        on_write=None,
+        on_fail=None,
+    ):
+        self._database = database
+        self._on_flush = on_flush
+        self._on_fail = on_fail
+        self._on_write = on_write
+        self._db = connect(database)
+        self._flush_size = flush_size
+        self._flush_age = flush_age
+        self._buffer = {}
+        self._outstanding = {}
+        self._finished = set()
+        self._completed = []
+        self._size = 0
+        self._oldest = None
+        self._closed = False
+        self._failures = 0
+        self._error = None
+        self._condition = threading.Condition()
+        self._thread = threading.Thread(target=self._run, daemon=True)
+        self._thread.start()
+
+    def store(
+        self,
+        curve: Any,
+        trait: str,
+        params: Dict[str, Any],
+        result: Dict[str, Any],
+        status: str = "ok",
+        tier: int = 0,
+        tag: Any = None,
+    ):
+        record = format_trait_result(curve, params, result, status, tier)
+        if tier == 0:
+            self.insert(f"trait_{trait}", record, tag)
+        else:
+            # Retries replace the timed out result
+            self.replace(
+                f"trait_{trait}",
+                {"curve.name": record["curve"]["name"], "params": record["params"]},
+                record,
+                tag,
+            )
+
+    def store_telemetry(
+        self, curve: Any, trait: str, params: Dict[str, Any], stats: Dict[str, Any], tag: Any = None
+    ):
+        self.insert("telemetry", format_telemetry(curve, trait, params, stats), tag)
+
+    def insert(self, collection: str, record: Dict[str, Any], tag: Any = None):
+        self._buffer_operation(collection, InsertOne(record), tag)
+
+    def replace(
+        self, collection: str, query: Dict[str, Any], record: Dict[str, Any], tag: Any = None
+    ):
+        self._buffer_operation(collection, ReplaceOne(query, record, upsert=True), tag)
+
+    def finish(self, tag: Any):
+        """Marks that no more operations with the tag follow, it is passed to on_flush once they are stored"""
+        with self._condition:
+            if self._outstanding.get(tag):
+                self._finished.add(tag)
+                return
+            self._completed.append(tag)
+            if self._oldest is None:
+                self._oldest = time.monotonic()
+
+    def _buffer_operation(self, collection, operation, tag):
+        with self._condition:
+            # Backpressure: do not let the buffer grow unboundedly when the database stalls
+            while (
+                self._size >= 10 * self._flush_size
+                and not self._closed
+                and self._error is None
+            ):
+                self._condition.wait()
+            self._raise()
+            self._buffer.setdefault(collection, []).append((operation, tag))
+            if tag is not None:
+                self._outstanding[tag] = self._outstanding.get(tag, 0) + 1
+            self._size += 1
+            if self._oldest is None:
+                self._oldest = time.monotonic()
+            if self._size >= self._flush_size:
+                self._condition.notify_all()
+
+    def _stored(self, operations):
+        """Counts the stored operations off their tags, completing finished tags without outstanding ones"""
+        with self._condition:
+            for _, tag in operations:
+                if tag is None:
+                    continue
+                self._outstanding[tag] -= 1
+                if self._outstanding[tag] == 0:
+                    del self._outstanding[tag]
+                    if tag in self._finished:
+                        self._finished.remove(tag)
+                        self._completed.append(tag)
+
+    def close(self):
+        with self._condition:
+            self._closed = True
+            self._condition.notify_all()
+        self._thread.join()
+        self._raise()
+
+    def _raise(self):
+        if self._error is not None:
+            raise ResultWriterError(
+                f"Results could not be stored after {FLUSH_RETRIES} attempts"
+            ) from self._error
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.close()
+
+    def _ready(self):
+        if self._size >= self._flush_size:
+            return True
+        return (
+            self._oldest is not None
+            and time.monotonic() - self._oldest >= self._flush_age
+        )
+
+    def _run(self):
+        while True:
+            with self._condition:
+                while not (self._closed or self._ready()):
+                    timeout = self._flush_age
+                    if self._oldest is not None:
+                        timeout -= time.monotonic() - self._oldest
+                    self._condition.wait(max(timeout, 0))
+                buffer, self._buffer = self._buffer, {}
+                self._size, self._oldest = 0, None
+                closed = self._closed
+                self._condition.notify_all()
+            error = None
+            failed = {}
+            for collection, operations in buffer.items():
+                try:
+                    self._flush(collection, [operation for operation, _ in operations])
+                    self._stored(operations)
+                except Exception as e:
+                    # Only the operations of collections that failed are retried
+                    error = e
+                    failed[collection] = operations
+            with self._condition:
+                completed, self._completed = self._completed, []
+            if completed and self._on_flush is not None:
+                try:
+                    self._on_flush(completed)
+                except Exception as e:
+                    error = e
+                else:
+                    completed = []
+            if error is None:
+                self._failures = 0
+                if closed:
+                    return
+                continue
+
+            self._failures += 1
+            lost = None
+            with self._condition:
+                for collection, operations in failed.items():
+                    self._buffer[collection] = operations + self._buffer.get(collection, [])
+                    self._size += len(operations)
+                # Tags not passed to on_flush yet are passed again with the next batch
+                self._completed = completed + self._completed
+                if self._oldest is None:
+                    self._oldest = time.monotonic()
+                if self._failures >= FLUSH_RETRIES:
+                    self._error = error
+                    self._condition.notify_all()
+                    lost = list(self._outstanding) + list(self._completed)
+            if lost is not None:
+                if lost and self._on_fail is not None:
+                    try:
+                        self._on_fail(lost)
+                    except Exception as e:
+                        print(f"[{datetime.datetime.now()}] Releasing unstored results failed ({e!r})")
+                return
+            delay = RETRY_DELAY * 2 ** (self._failures - 1)
+            print(
+                f"[{datetime.datetime.now()}] Storing results failed ({error!r}), retrying in {delay:.0f}s"
+            )
+            time.sleep(delay)
+
+    def _flush(self, collection, operations):
+        for i in range(CONNECTION_ATTEMPTS):
+            try:
+                start = time.perf_counter()
+                store_operations(self._db, collection, operations)
+                if self._on_write is not None:
+                    self._on_write(time.perf_counter() - start)
+                return
+            except ServerSelectionTimeoutError:
+                if i == CONNECTION_ATTEMPTS - 1:
+                    raise
+                print(
+                    f"[{datetime.datetime.now()}] Server timeout: Reconnection attempt {i}"
+                )
+                self._db = connect(self._database)
+
+
+def test_failed_flush_is_retried(monkeypatch):
+    from pymongo.errors import AutoReconnect
+
+    import dissect.utils.result_writer as module
+
+    stored, flushed = [], []
+
+    def flaky(db, collection, operations):
+        if not stored:
+            stored.append(None)
+            raise AutoReconnect("connection reset")
+        stored.extend(operations)
+
+    monkeypatch.setattr(module, "store_operations", flaky)
+    monkeypatch.setattr(module, "RETRY_DELAY", 0.01)
+    writer = ResultWriter("mongodb://localhost:1", flush_size=2, on_flush=flushed.extend)
+    writer.insert("trait_a", {"x": 1}, tag=1)
+    writer.finish(1)
+    writer.insert("trait_a", {"x": 2}, tag=2)
+    writer.finish(2)
+    writer.close()
+    assert len(stored) == 3
+    assert flushed == [1, 2]
+
+
+def test_tag_completes_after_all_operations(monkeypatch):
+    from pymongo.errors import AutoReconnect
+
+    import dissect.utils.result_writer as module
+
+    batches, flushed = [], []
+
+    def flaky(db, collection, operations):
+        batches.append(collection)
+        if collection == "trait_a" and batches.count("trait_a") == 1:
+            raise AutoReconnect("connection reset")
+
+    monkeypatch.setattr(module, "store_operations", flaky)
+    monkeypatch.setattr(module, "RETRY_DELAY", 0.5)
+    writer = ResultWriter("mongodb://localhost:1", flush_size=1, on_flush=flushed.extend)
+    # The first operation of the job fails, the later one is stored, the job is complete only after the retry
+    writer.insert("trait_a", {"x": 1}, tag=1)
+    time.sleep(0.1)
+    writer.insert("telemetry", {"x": 1}, tag=1)
+    writer.finish(1)
+    time.sleep(0.1)
+    assert flushed == []
+    writer.close()
+    assert batches.count("trait_a") == 2
+    assert flushed == [1]
+
+
+def test_writer_gives_up(monkeypatch):
+    from pymongo.errors import BulkWriteError
+
+    import dissect.utils.result_writer as module
+
+    def failing(db, collection, operations):
+        raise BulkWriteError({"writeErrors": [{"code": 121}]})
+
+    monkeypatch.setattr(module, "store_operations", failing)
+    monkeypatch.setattr(module, "RETRY_DELAY", 0.001)
+    flushed, failed = [], []
+    writer = ResultWriter(
+        "mongodb://localhost:1", flush_size=1, on_flush=flushed.extend, on_fail=failed.extend
+    )
+    writer.insert("trait_a", {"x": 1}, tag=1)
+    writer.finish(1)
+    writer._thread.join()
+    try:
+        writer.insert("trait_a", {"x": 2}, tag=2)
+        assert False
+    except ResultWriterError:
+        pass
+    try:
+        writer.close()
+        assert False
+    except ResultWriterError:
+        pass
+    assert flushed == []
+    assert failed == [1]
@@ -0,0 +1,264 @@
+import os
+import signal
+import threading
+import time
+from queue import Empty
+
+from dissect.utils.utils import TIMEOUT_TIERS
+
+RECYCLE_EXIT_CODE = 75
+SUPERVISE_INTERVAL = 1.0
+HARD_TIMEOUT = 3600
+
+
+def own_process_group():
+    """Called by a worker when it starts, so that killing its group also kills the processes it started"""
+    os.setpgid(0, 0)
+
+
+def kill_group(process):
+    """Kills the worker process together with its process group"""
+    try:
+        os.killpg(process.pid, signal.SIGKILL)
+    except (ProcessLookupError, PermissionError):
+        # The worker did not get its own group yet
+        process.kill()
+
+
+class Supervisor:
+    """Keeps a pool of worker processes alive: restarts recycled or crashed workers and kills hung tasks
+
+    Workers report on the control queue:
+        ("job", identifier, key, payload, requeued)  a job was taken, payload is passed to requeue if it is lost
+        ("task", identifier, key, position, tier)    a task of the job started
+        ("idle", identifier)                         the job is computed
+        ("committed", identifier, keys)              the results of the jobs are stored
+        ("stopping", identifier)                     the worker took its stop sentinel from the queue
+    A worker that exits before its jobs are committed loses them, including those it did not start yet and those
+    whose results were still buffered. requeue(payload, position, status) is called for each of them and
+    returns True when the job was put back to the queue the workers read from, so that the supervisor makes
+    sure some worker is left to compute it. A worker lost after it took its stop sentinel is replaced by one
+    that gets a sentinel again (spawn with drain set), so that the replacement stops as well.
+    """
+
+    def __init__(self, spawn, count, control, log, requeue=None, hard_timeout=HARD_TIMEOUT):
+        self._spawn = spawn
+        self._count = count
+        self._control = control
+        self._log = log
+        self._requeue = requeue
+        self._hard_timeout = hard_timeout
+        self._processes = {}
+        self._killed = set()
+        self._stopping = set()
+        self._jobs = {}
+        self._tasks = {}
+        self._pending = 0
+        self._stop = threading.Event()
+        self.restarts = 0
+
+    def _receive(self):
+        while True:
+            try:
+                message = self._control.get_nowait()
+            except Empty:
+                return
+            kind, identifier = message[0], message[1]
+            if kind == "job":
+                self._jobs.setdefault(identifier, {})[message[2]] = message[3]
+                if message[4]:
+                    self._pending = max(self._pending - 1, 0)
+            elif kind == "task":
+                self._tasks[identifier] = (time.monotonic(), message[2], message[3], message[4])
+            elif kind == "idle":
+                self._tasks.pop(identifier, None)
+            elif kind == "stopping":
+                self._stopping.add(identifier)
+            elif kind == "committed":
+                jobs = self._jobs.get(identifier, {})
+                for key in message[2]:
+                    jobs.pop(key, None)
+
+    def _hung(self, identifier):
+        if not self._hard_timeout or identifier not in self._tasks:
+            return False
+        started, _, _, tier = self._tasks[identifier]
+        return time.monotonic() - started > self._hard_timeout * TIMEOUT_TIERS[tier]
+
+    def _lost(self, identifier, status):
+        jobs = self._jobs.pop(identifier, {})
+        task = self._tasks.pop(identifier, None)
+        if self._requeue is None:
+            return
+        for key, payload in jobs.items():
+            # Only the job computed at the time is charged with the status of the loss
+            position = task[2] if task is not None and task[1] == key else None
+            if self._requeue(payload, position, status):
+                self._pending += 1
+
+    def stop(self):
+        """Makes run kill the workers and return, e.g. when the program is interrupted"""
+        self._stop.set()
+
+    def run(self):
+        try:
+            self._supervise()
+        finally:
+            for process in self._processes.values():
+                if process.exitcode is None:
+                    kill_group(process)
+                    process.join()
+
+    def _supervise(self):
+        for identifier in range(1, self._count + 1):
+            self._processes[identifier] = self._spawn(identifier)
+        while self._processes and not self._stop.wait(SUPERVISE_INTERVAL):
+            self._receive()
+            for identifier, process in list(self._processes.items()):
+                if process.is_alive() and self._hung(identifier):
+                    position = self._tasks[identifier][2]
+                    self._log(
+                        f"Worker {identifier:2d} exceeded the hard time limit on task {position}, killing it"
+                    )
+                    kill_group(process)
+                    process.join()
+                    self._killed.add(identifier)
+                process.join(0)
+                if process.exitcode is None:
+                    continue
+                # Processes the worker started and left behind, e.g. forks of a crashed computation
+                try:
+                    os.killpg(process.pid, signal.SIGKILL)
+                except (ProcessLookupError, PermissionError):
+                    pass
+                # Messages sent right before the exit may still be on the way
+                self._receive()
+                if identifier in self._killed:
+                    self._killed.remove(identifier)
+                    self._lost(identifier, "timeout")
+                elif process.exitcode not in (0, RECYCLE_EXIT_CODE):
+                    self._log(f"Worker {identifier:2d} died with exit code {process.exitcode}")
+                    self._lost(identifier, "failed")
+                else:
+                    # A worker leaving normally stored all of its jobs, any other one is requeued
+                    self._lost(identifier, None)
+                drain = identifier in self._stopping
+                self._stopping.discard(identifier)
+                if process.exitcode == 0:
+                    del self._processes[identifier]
+                    continue
+                self._processes[identifier] = self._spawn(identifier, drain=drain)
+                self.restarts += 1
+            if not self._processes and self._pending > 0:
+                # Every worker got its stop signal before a requeued job reached the queue
+                self._processes[1] = self._spawn(1, drain=True)
+                self._pending = 0
+
+
+class _Process:
+    """Stands in for a worker process that exits with the given code once the supervisor looks at it"""
+
+    def __init__(self, exitcode):
+        self.pid = -1
+        self.exitcode = None
+        self._exit = exitcode
+
+    def is_alive(self):
+        return self.exitcode is None
+
+    def join(self, timeout=None):
+        if self._exit is not None:
+            self.exitcode = self._exit
+
+
+def _supervise(monkeypatch, spawn, control, hard_timeout=HARD_TIMEOUT):
+    import dissect.utils.supervisor as module
+
+    def kill(process):
+        process.exitcode = -signal.SIGKILL
+
+    monkeypatch.setattr(module, "SUPERVISE_INTERVAL", 0.001)
+    monkeypatch.setattr(module, "kill_group", kill)
+    monkeypatch.setattr(module.os, "killpg", lambda pid, sig: None)
+    requeued = []
+
+    def requeue(payload, position, status):
+        requeued.append((payload, position, status))
+        return False
+
+    supervisor = Supervisor(spawn, 1, control, lambda message: None, requeue, hard_timeout)
+    supervisor.run()
+    return supervisor, requeued
+
+
+def test_crashed_worker_loses_uncommitted_jobs(monkeypatch):
+    from queue import Queue
+
+    control, spawned = Queue(), []
+
+    def spawn(identifier, drain=False):
+        if not spawned:
+            control.put(("job", identifier, 1, "a", False))
+            control.put(("job", identifier, 2, "b", False))
+            control.put(("job", identifier, 3, "c", False))
+            control.put(("committed", identifier, [1]))
+            control.put(("task", identifier, 2, 5, 0))
+        spawned.append(identifier)
+        return _Process(1 if len(spawned) == 1 else 0)
+
+    supervisor, requeued = _supervise(monkeypatch, spawn, control)
+    assert requeued == [("b", 5, "failed"), ("c", None, "failed")]
+    assert supervisor.restarts == 1
+
+
+def test_hung_worker_is_killed(monkeypatch):
+    from queue import Queue
+
+    control, spawned = Queue(), []
+
+    def spawn(identifier, drain=False):
+        if not spawned:
+            control.put(("job", identifier, 1, "a", False))
+            control.put(("task", identifier, 1, 0, 0))
+        spawned.append(identifier)
+        # The first worker never exits by itself
+        return _Process(None if len(spawned) == 1 else 0)
+
+    supervisor, requeued = _supervise(monkeypatch, spawn, control, hard_timeout=0.01)
+    assert requeued == [("a", 0, "timeout")]
+    assert supervisor.restarts == 1
+
+
+def test_recycled_worker_requeues_buffered_jobs(monkeypatch):
+    from queue import Queue
+
+    control, spawned = Queue(), []
+
+    def spawn(identifier, drain=False):
+        if not spawned:
+            control.put(("job", identifier, 1, "a", False))
+            control.put(("idle", identifier))
+        spawned.append(identifier)
+        return _Process(RECYCLE_EXIT_CODE if len(spawned) == 1 else 0)
+
+    supervisor, requeued = _supervise(monkeypatch, spawn, control)
+    assert requeued == [("a", None, None)]
+    assert supervisor.restarts == 1
+
+
+def test_stopping_worker_is_replaced_by_a_draining_one(monkeypatch):
+    from queue import Queue
+
+    control, spawned = Queue(), []
+
+    def spawn(identifier, drain=False):
+        if not spawned:
+            # A deferred job is left when the worker dies after taking its sentinel
+            control.put(("job", identifier, 1, "a", False))
+            control.put(("stopping", identifier))
+        spawned.append(drain)
+        return _Process(-signal.SIGKILL if len(spawned) == 1 else 0)
+
+    supervisor, requeued = _supervise(monkeypatch, spawn, control)
+    assert requeued == [("a", None, "failed")]
+    assert spawned == [False, True]
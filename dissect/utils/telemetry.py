@@ -0,0 +1,130 @@
+import os
+import resource
+import time
+import traceback
+from typing import Any, Callable, Dict, Tuple
+
+TIMEOUT_MESSAGE = "NO DATA (timed out)"
+FAILURE_MESSAGES = ("NO DATA", "INVALID DATA")
+
+
+def result_status(result: Any) -> str:
+    """Classifies a trait result as 'ok', 'timeout' or 'failed' based on the messages left by timed computations"""
+    if isinstance(result, str):
+        if result == TIMEOUT_MESSAGE:
+            return "timeout"
+        if result.startswith(FAILURE_MESSAGES):
+            return "failed"
+        return "ok"
+    if isinstance(result, dict):
+        values = result.values()
+    elif isinstance(result, (list, tuple)):
+        values = result
+    else:
+        return "ok"
+    statuses = set(map(result_status, values))
+    for status in ("timeout", "failed"):
+        if status in statuses:
+            return status
+    return "ok"
+
+
+def _cpu_time():
+    from dissect.utils.timeout_pool import TIMEOUT_POOL
+
+    children = resource.getrusage(resource.RUSAGE_CHILDREN)
+    return time.process_time() + children.ru_utime + children.ru_stime + TIMEOUT_POOL.cpu_time()
+
+
+def reset_peak_rss() -> bool:
+    """Resets the peak RSS of the process to its current RSS, returns False where this is not supported"""
+    try:
+        with open("/proc/self/clear_refs", "w") as f:
+            f.write("5")
+        return True
+    except OSError:
+        return False
+
+
+def peak_rss() -> int:
+    """Peak RSS of the process in bytes since the last reset_peak_rss (VmHWM)"""
+    with open("/proc/self/status") as f:
+        for line in f:
+            if line.startswith("VmHWM:"):
+                return int(line.split()[1]) * 1024
+    raise OSError("VmHWM not available")
+
+
+def _task_peak_rss(reset, children):
+    """Peak RSS in bytes of the work done since reset_peak_rss in this process, the helper of the timeout pool and
+    children reaped meanwhile, None if the peak of the process cannot be reset"""
+    from dissect.utils.timeout_pool import TIMEOUT_POOL
+
+    if not reset:
+        return None
+    try:
+        peak = max(peak_rss(), TIMEOUT_POOL.peak_rss())
+    except OSError:
+        return None
+    # ru_maxrss of children is the largest of all children ever reaped, it only tells about this task if it grew
+    reaped = resource.getrusage(resource.RUSAGE_CHILDREN).ru_maxrss
+    if reaped > children:
+        peak = max(peak, reaped * 1024)
+    return peak
+
+
+def _process_peak_rss():
+    from dissect.utils.timeout_pool import TIMEOUT_POOL
+
+    # ru_maxrss is reported in kilobytes on Linux
+    peak = max(
+        resource.getrusage(resource.RUSAGE_SELF).ru_maxrss,
+        resource.getrusage(resource.RUSAGE_CHILDREN).ru_maxrss,
+    )
+    return max(peak * 1024, TIMEOUT_POOL.peak_rss())
+
+
+def current_rss() -> int:
+    """Resident set size of the process in bytes, falls back to the peak where /proc is not available"""
+    try:
+        with open("/proc/self/statm") as f:
+            return int(f.read().split()[1]) * os.sysconf("SC_PAGE_SIZE")
+    except (OSError, ValueError):
+        return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss * 1024
+
+
+def measure(func: Callable, *args, **kwargs) -> Tuple[Any, Dict[str, Any]]:
+    """Runs func and returns its result together with wall time, CPU time (including forked children),
+    peak RSS of the computation and its status
+
+    The peak RSS is stored as rss where the peak of the process can be reset before the computation. Elsewhere
+    only the peak over the lifetime of the process is known, it is stored as process_rss instead, which is not
+    attributed to the task.
+    """
+    from dissect.utils.timeout_pool import TIMEOUT_POOL
+
+    TIMEOUT_POOL.reset_peak_rss()
+    reset = reset_peak_rss()
+    children = resource.getrusage(resource.RUSAGE_CHILDREN).ru_maxrss
+    wall, cpu = time.perf_counter(), _cpu_time()
+    error = None
+    try:
+        result = func(*args, **kwargs)
+        status = result_status(result)
+    except Exception:
+        result = None
+        status = "failed"
+        error = traceback.format_exc(limit=-1).strip()
+    stats = {
+        "wall": time.perf_counter() - wall,
+        "cpu": _cpu_time() - cpu,
+    }
+    rss = _task_peak_rss(reset, children)
+    if rss is None:
+        stats["process_rss"] = _process_peak_rss()
+    else:
+        stats["rss"] = rss
+    stats["status"] = status
+    if error:
+        stats["error"] = error
+    return result, stats
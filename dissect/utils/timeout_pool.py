@@ -0,0 +1,288 @@
+import math
+import os
+import pickle
+import resource
+import signal
+import time
+from multiprocessing import Pipe
+from multiprocessing.connection import wait
+
+from dissect.utils.telemetry import TIMEOUT_MESSAGE, peak_rss, reset_peak_rss
+
+FAILURE_MESSAGE = "NO DATA"
+HELPER_MAX_JOBS = 500
+# Returned when a job cannot be sent to the helper (e.g. a lambda), the caller forks for it instead
+UNAVAILABLE = object()
+
+
+def _kill(pid):
+    """Kills a helper with the process group it leads, including the external programs it started"""
+    try:
+        os.killpg(pid, signal.SIGKILL)
+    except (ProcessLookupError, PermissionError):
+        # The helper already exited and was reaped, or did not get its own group yet
+        try:
+            os.kill(pid, signal.SIGKILL)
+        except ProcessLookupError:
+            pass
+
+
+def _reap(fd):
+    groups = set()
+    with os.fdopen(fd, "rb") as pipe:
+        for line in pipe:
+            pgid = int(line)
+            if pgid > 0:
+                groups.add(pgid)
+            else:
+                groups.discard(-pgid)
+    for pgid in groups:
+        try:
+            os.killpg(pgid, signal.SIGKILL)
+        except (ProcessLookupError, PermissionError):
+            pass
+    os._exit(0)
+
+
+class GroupReaper:
+    """Kills the process groups of helpers and raced calls left behind when the process that started them ends
+
+    Helpers lead their own process groups, so they are not killed with the group of their parent. A small
+    process forked on first use reads the groups to watch from a pipe; however the parent ends, even killed,
+    the pipe reaches its end and the reaper kills the groups still watched.
+    """
+
+    def __init__(self):
+        self._pipe = None
+        self._owner = None
+
+    def _start(self):
+        read, write = os.pipe()
+        try:
+            pid = os.fork()
+        except OSError:
+            os.close(read)
+            os.close(write)
+            raise
+        if pid == 0:
+            os.close(write)
+            # Not killed together with the group of the parent
+            os.setpgid(0, 0)
+            signal.signal(signal.SIGTERM, signal.SIG_IGN)
+            signal.signal(signal.SIGINT, signal.SIG_IGN)
+            _reap(read)
+        os.close(read)
+        self._pipe = write
+        self._owner = os.getpid()
+
+    def _send(self, value):
+        if self._owner != os.getpid():
+            self._start()
+        try:
+            os.write(self._pipe, f"{value}\n".encode())
+        except BrokenPipeError:
+            # The reaper was killed, a new one watches the groups from now on
+            os.close(self._pipe)
+            # Not closed again by detach if no reaper can be started, the number may belong to another file
+            self._pipe = None
+            self._owner = None
+            self._start()
+            os.write(self._pipe, f"{value}\n".encode())
+
+    def watch(self, pgid):
+        self._send(pgid)
+
+    def forget(self, pgid):
+        self._send(-pgid)
+
+    def detach(self):
+        """Closes the pipe of the parent in a forked child, so that the pipe ends with the parent"""
+        if self._pipe is not None and self._owner != os.getpid():
+            os.close(self._pipe)
+            self._pipe = None
+            self._owner = None
+
+
+REAPER = GroupReaper()
+os.register_at_fork(after_in_child=REAPER.detach)
+
+
+def _serve(connection):
+    while True:
+        try:
+            func, args, kwargs = connection.recv()
+        except (EOFError, OSError):
+            os._exit(0)
+        cpu = time.process_time()
+        reset = reset_peak_rss()
+        try:
+            result = ("ok", func(*args, **kwargs))
+        except Exception:
+            result = ("error", None)
+        try:
+            # Peak of this call if it could be reset, of the whole helper otherwise
+            rss = peak_rss() if reset else resource.getrusage(resource.RUSAGE_SELF).ru_maxrss * 1024
+        except OSError:
+            rss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss * 1024
+        usage = (time.process_time() - cpu, rss)
+        try:
+            connection.send(result + usage)
+        except (pickle.PicklingError, TypeError, AttributeError):
+            connection.send(("unpicklable", None) + usage)
+
+
+class TimeoutPool:
+    """Long-lived helper process executing timed calls, replaced only when a call exceeds its deadline
+
+    The helper is forked from the calling process on first use, so it starts with Sage already loaded,
+    and a timed call costs a round trip through a pipe instead of a fork of the whole process.
+    """
+
+    def __init__(self, max_jobs=HELPER_MAX_JOBS):
+        self._max_jobs = max_jobs
+        self._helper = None
+        self._owner = None
+        self._jobs = 0
+        self._helper_cpu = 0.0
+        self._peak_rss = 0
+
+    def cpu_time(self):
+        """CPU seconds of the live helper, not yet included in the resource usage of reaped children"""
+        return self._helper_cpu if self._owner == os.getpid() else 0.0
+
+    def peak_rss(self):
+        """Peak RSS in bytes of the calls of helpers since reset_peak_rss"""
+        return self._peak_rss if self._owner == os.getpid() else 0
+
+    def reset_peak_rss(self):
+        self._peak_rss = 0
+
+    def _start(self):
+        parent, child = Pipe()
+        pid = os.fork()
+        if pid == 0:
+            parent.close()
+            os.setpgid(0, 0)
+            signal.signal(signal.SIGTERM, signal.SIG_DFL)
+            signal.signal(signal.SIGINT, signal.SIG_IGN)
+            _serve(child)
+        child.close()
+        REAPER.watch(pid)
+        self._helper = (pid, parent)
+        self._owner = os.getpid()
+        self._jobs = 0
+        self._helper_cpu = 0.0
+
+    def _stop(self, kill):
+        pid, connection = self._helper
+        self._helper = None
+        connection.close()
+        if kill:
+            _kill(pid)
+        # Once reaped, the helper is accounted in the resource usage of children
+        os.waitpid(pid, 0)
+        REAPER.forget(pid)
+        self._helper_cpu = 0.0
+
+    def call(self, func, args, kwargs, timeout_duration):
+        if self._helper is None or self._owner != os.getpid():
+            # A forked child must not talk to the helper of its parent
+            self._helper = None
+            self._start()
+        _, connection = self._helper
+        try:
+            connection.send((func, args, kwargs))
+        except (pickle.PicklingError, TypeError, AttributeError):
+            return UNAVAILABLE
+        except OSError:
+            self._stop(kill=True)
+            return UNAVAILABLE
+
+        if not connection.poll(timeout_duration):
+            self._stop(kill=True)
+            return TIMEOUT_MESSAGE
+        try:
+            status, result, cpu, rss = connection.recv()
+        except (EOFError, OSError):
+            # The helper crashed, e.g. PARI ran out of stack
+            self._stop(kill=True)
+            return FAILURE_MESSAGE
+        self._helper_cpu += cpu
+        self._peak_rss = max(self._peak_rss, rss)
+
+        self._jobs += 1
+        if self._jobs >= self._max_jobs:
+            self._stop(kill=False)
+        if status == "ok":
+            return result
+        if status == "error":
+            return FAILURE_MESSAGE
+        return UNAVAILABLE
+
+
+TIMEOUT_POOL = TimeoutPool()
+
+
+def available_cores():
+    """Cores this process may run on"""
+    return len(os.sched_getaffinity(0)) if hasattr(os, "sched_getaffinity") else os.cpu_count()
+
+
+def idle_cores():
+    """Cores of this process left idle according to the one-minute load average"""
+    return max(available_cores() - math.ceil(os.getloadavg()[0]), 0)
+
+
+def _child(func, args):
+    parent, child = Pipe(duplex=False)
+    pid = os.fork()
+    if pid == 0:
+        parent.close()
+        # Own process group, so that cancelling also kills external programs like GMP-ECM
+        os.setpgid(0, 0)
+        signal.signal(signal.SIGTERM, signal.SIG_DFL)
+        signal.signal(signal.SIGINT, signal.SIG_IGN)
+        try:
+            result = func(*args)
+        except Exception:
+            result = None
+        try:
+            child.send(result)
+        except (pickle.PicklingError, TypeError, AttributeError):
+            pass
+        os._exit(0)
+    child.close()
+    REAPER.watch(pid)
+    return pid, parent
+
+
+def race(calls, timeout_duration):
+    """Runs the (func, args) calls at once, each in its own fork, and returns the first result that is not None,
+    cancelling the other calls. Returns None if no call had a result, TIMEOUT_MESSAGE if none had it in time."""
+    deadline = time.monotonic() + timeout_duration
+    children = {}
+    try:
+        for func, args in calls:
+            pid, connection = _child(func, args)
+            children[connection] = pid
+        pending = list(children)
+        while pending:
+            ready = wait(pending, timeout=max(deadline - time.monotonic(), 0))
+            if not ready:
+                return TIMEOUT_MESSAGE
+            for connection in ready:
+                pending.remove(connection)
+                try:
+                    result = connection.recv()
+                except (EOFError, OSError):
+                    # The call crashed or its result could not be sent
+                    continue
+                if result is not None:
+                    return result
+        return None
+    finally:
+        for connection, pid in children.items():
+            connection.close()
+            _kill(pid)
+            os.waitpid(pid, 0)
+            REAPER.forget(pid)
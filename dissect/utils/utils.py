@@ -1,6 +1,269 @@
-from sage.all import ZZ, ecm, factor, sqrt
+import time
+from collections import Counter
+from math import gcd
+
+from sage.all import ZZ, ecm, factor, qsieve, sqrt
 from sage.parallel.decorate import fork
 
+from dissect.utils.factor_cache import FACTOR_CACHE
+from dissect.utils.inline_path import INLINE_PREDICTOR
+from dissect.utils.telemetry import TIMEOUT_MESSAGE, result_status
+from dissect.utils.timeout_pool import FAILURE_MESSAGE, TIMEOUT_POOL, UNAVAILABLE, idle_cores, race
+
+# Multiples of the default timeouts used by successive retries of timed out computations
+TIMEOUT_TIERS = (1, 4, 16)
+_timeout_scale = 1
+
+# Stages of the factorization: trial division up to TRIAL_BOUND, Pollard rho, ECM with escalating
+# (B1, curves) levels until ECM_SHARE of the budget is spent, then a complete factorization (PARI, or GMP-ECM
+# with use_ecm) with the rest. The ECM stage is skipped for composites PARI is expected to factor in the rest.
+TRIAL_BOUND = 2**16
+RHO_ITERATIONS = 2**16
+RHO_SHARE = 0.05
+ECM_LEVELS = ((2000, 25), (11000, 90), (50000, 300), (250000, 700), (1000000, 1800))
+ECM_SHARE = 0.25
+# Smaller composites are left to PARI right away
+STAGED_MIN_BITS = 128
+# Rough time of PARI on a composite without small factors: a second at PARI_REFERENCE_BITS, doubling every
+# PARI_DOUBLING_BITS bits
+PARI_REFERENCE_BITS = 170
+PARI_DOUBLING_BITS = 16
+# Composites in this range are also raced against the quadratic sieve in portfolio mode
+QS_BITS = (130, 330)
+# Largest number of strategies raced on one composite, on idle cores only
+_portfolio = 1
+# Core budget of the node shared by its workers and the identifier of this worker, None to go by the load alone
+_cores = None
+
+
+def set_timeout_tier(tier):
+    """Scales the durations of all subsequent timed computations according to the budget tier"""
+    global _timeout_scale
+    _timeout_scale = TIMEOUT_TIERS[tier]
+
+
+def set_portfolio(width):
+    """Races up to width factorization strategies on each composite left for PARI, as long as cores are idle"""
+    global _portfolio
+    _portfolio = width
+
+
+def set_core_budget(cores, identifier):
+    """Lends the cores racing strategies run on from the core budget shared by the workers of the node, so that
+    workers seeing the same idle cores do not all race on them"""
+    global _cores
+    _cores = None if cores is None else (cores, identifier)
+
+
+def portfolio_width():
+    """Number of strategies to race on one composite, the cores lent for it are given back by return_cores"""
+    if _portfolio <= 1:
+        return 1
+    if _cores is None:
+        return min(_portfolio, 1 + idle_cores())
+    cores, identifier = _cores
+    return 1 + cores.take(identifier, min(_portfolio - 1, idle_cores()))
+
+
+def return_cores():
+    if _cores is not None:
+        cores, identifier = _cores
+        cores.give(identifier)
+
+
+def pari_seconds(bits):
+    return 2 ** ((bits - PARI_REFERENCE_BITS) / PARI_DOUBLING_BITS)
+
+
+def pollard_rho(n, iterations):
+    """Brent's variant of Pollard's rho, returns a nontrivial factor of n or None"""
+    n = int(n)
+    for c in (1, 3, 5):
+        y, r, q, g = 2, 1, 1, 1
+        x = ys = y
+        done = 0
+        while g == 1 and done < iterations:
+            x = y
+            for _ in range(r):
+                y = (y * y + c) % n
+            k = 0
+            while k < r and g == 1:
+                ys = y
+                for _ in range(min(128, r - k)):
+                    y = (y * y + c) % n
+                    q = q * abs(x - y) % n
+                g = gcd(q, n)
+                k += 128
+            done += r
+            r *= 2
+        if g == n:
+            g = 1
+            while g == 1:
+                ys = (ys * ys + c) % n
+                g = gcd(abs(x - ys), n)
+        if 1 < g < n:
+            return ZZ(g)
+    return None
+
+
+# ECM runs the external ecm program, which an alarm in this process would not stop, so it is only run sandboxed
+@INLINE_PREDICTOR.sandbox_always
+def ecm_find_factor(n, b1, curves):
+    """Runs the given number of ECM curves with bound b1, returns a nontrivial factor of n or None"""
+    factors = ecm.find_factor(n, B1=b1, c=curves)
+    for f in factors:
+        if 1 < f < n:
+            return ZZ(f)
+    return None
+
+
+def qs_find_factor(n):
+    """Runs the quadratic sieve, returns a nontrivial factor of n or None"""
+    result = qsieve(n)
+    factors = result[0] if isinstance(result, tuple) else result
+    for f in factors:
+        if 1 < f < n:
+            return ZZ(f)
+    return None
+
+
+def pari_factor(n):
+    return list(factor(n))
+
+
+@INLINE_PREDICTOR.sandbox_always
+def ecm_factor(n):
+    return sorted(Counter(ZZ(p) for p in ecm.factor(n)).items())
+
+
+def portfolio(n, width, ecm_level, complete=pari_factor):
+    """Strategies for the composite n: the complete factorization, the quadratic sieve for mid-size n and ECM
+    runs (each with its own random curves) starting at the first level not completed yet"""
+    calls = [(complete, (n,))]
+    if QS_BITS[0] <= n.nbits() <= QS_BITS[1]:
+        calls.append((qs_find_factor, (n,)))
+    level = ecm_level
+    while len(calls) < width:
+        calls.append((ecm_find_factor, (n,) + ECM_LEVELS[min(level, len(ECM_LEVELS) - 1)]))
+        level += 1
+    return calls[:width]
+
+
+def staged_factorization(value, budget, use_ecm=False, known=None):
+    """Factors |value| in stages within budget seconds, continuing from a known (factors, composites, effort)
+
+    The stages together take at most the budget, the complete factorization at the end gets what the earlier
+    ones left.
+
+    Returns the prime factors with exponents, the composites left unfactored and the effort spent, i.e. the
+    seconds, whether Pollard rho ran and the number of completed ECM levels. The effort has failed set when a
+    composite is left because the complete factorization crashed rather than ran out of time.
+    """
+    start = time.monotonic()
+    primes, composites = Counter(), []
+
+    def spent():
+        return time.monotonic() - start
+
+    def timed(func, args, seconds):
+        # Durations of timeout are scaled by the tier, the budget already is
+        return timeout(func, args, timeout_duration=max(seconds, 0) / _timeout_scale)
+
+    def add(n, e=1):
+        n = ZZ(n)
+        if n == 1:
+            return
+        if n.is_pseudoprime():
+            primes[n] += e
+        else:
+            composites.extend([n] * e)
+
+    if known is None:
+        effort = {"seconds": 0.0, "rho": False, "ecm": 0}
+        n = abs(ZZ(value))
+        while n > 1:
+            p = n.trial_division(TRIAL_BOUND)
+            if p == n and n > TRIAL_BOUND:
+                break
+            primes[p] += 1
+            n //= p
+        add(n)
+    else:
+        factors, known_composites, effort = known
+        effort = dict({"seconds": 0.0, "rho": False, "ecm": 0}, **effort)
+        for p, e in factors:
+            primes[ZZ(p)] += e
+        composites.extend(ZZ(c) for c in known_composites)
+
+    def split(method, args, deadline):
+        """Tries method on each composite until deadline seconds from the start, replacing it by its parts
+        when a factor is found. Returns whether every composite was tried to the end"""
+        finished = True
+        for n in list(composites):
+            if spent() >= min(deadline, budget):
+                finished = False
+                break
+            f = timed(method, (n,) + args, min(deadline, budget) - spent())
+            if isinstance(f, str):
+                finished = False
+                continue
+            if f is not None:
+                composites.remove(n)
+                add(f)
+                add(n // f)
+        return finished
+
+    large = any(n.nbits() >= STAGED_MIN_BITS for n in composites)
+    if composites and large and not effort["rho"]:
+        effort["rho"] = split(pollard_rho, (RHO_ITERATIONS,), RHO_SHARE * budget)
+    ecm_budget = ECM_SHARE * budget
+
+    def needs_ecm():
+        # GMP-ECM completes what the levels started, PARI is left the composites it factors in time alone
+        if use_ecm:
+            return True
+        largest = max(n.nbits() for n in composites)
+        return largest >= STAGED_MIN_BITS and pari_seconds(largest) > budget - spent()
+
+    while composites and effort["ecm"] < len(ECM_LEVELS) and needs_ecm():
+        if spent() >= ecm_budget or not split(ecm_find_factor, ECM_LEVELS[effort["ecm"]], ecm_budget):
+            break
+        effort["ecm"] += 1
+
+    # The complete factorization gets the budget the earlier stages left
+    complete = ecm_factor if use_ecm else pari_factor
+    deadline = start + budget
+    pending = list(composites)
+    while pending and deadline - time.monotonic() > 0:
+        n = pending.pop()
+        width = portfolio_width()
+        if width > 1:
+            # The first strategy to finish wins, the factorization is the same whichever it is
+            try:
+                found = race(portfolio(n, width, effort["ecm"], complete), deadline - time.monotonic())
+            finally:
+                return_cores()
+        else:
+            found = timed(complete, (n,), deadline - time.monotonic())
+        if found is None or isinstance(found, str):
+            # The complete factorization is part of every race, a race without result means it crashed too
+            if found is None or result_status(found) == "failed":
+                effort["failed"] = True
+            continue
+        composites.remove(n)
+        if isinstance(found, list):
+            for p, e in found:
+                primes[ZZ(p)] += e
+        else:
+            # A factor found by ECM or the sieve, the parts left composite are factored in turn
+            left = len(composites)
+            add(found)
+            add(n // found)
+            pending.extend(composites[left:])
+
+    effort["seconds"] += spent()
+    return sorted(primes.items()), sorted(composites), effort
+
 
 class Factorization:
     def __init__(self, x, use_ecm=False, timeout_duration=20, factorization=None):
@@ -10,6 +273,9 @@ class Factorization:
         self._square_root = None
         self._factorization = None
         self._timeout = False
+        self._partial = []
+        self._composites = []
+        self._effort = {}
         self._use_ecm = use_ecm
         self._timeout_duration = timeout_duration
         self._unit = 1 if x >= 0 else -1
@@ -39,25 +305,59 @@ class Factorization:
             return [i for (i, e) in self._factorization for _ in range(e)]
         return self._factorization
 
+    def partial_factorization(self, unpack=True):
+        """Prime factors found so far, all of them unless the factorization timed out"""
+        if unpack:
+            return [i for (i, e) in self._partial for _ in range(e)]
+        return self._partial
+
+    def cofactors(self):
+        """Composite parts of the value left unfactored"""
+        return self._composites
+
+    def effort(self):
+        return self._effort
+
     def set_factorization(self, factorization):
         if factorization is not None:
             self._factorization = factorization
             if isinstance(factorization, str):
                 self._timeout = True
-        elif self._use_ecm:
-            factors = timeout(ecm.factor, [self._value], timeout_duration=self._timeout_duration)
-            if isinstance(factors, str):
-                self._timeout = True
-                self._factorization = factors
             else:
-                self._factorization = [(i, factors.count(i)) for i in set(factors)]
+                self._partial = factorization
+            return
+        if self._value == 0:
+            self._timeout = True
+            self._factorization = FAILURE_MESSAGE
+            return
+        budget = self._timeout_duration * _timeout_scale
+        cached = FACTOR_CACHE.get(self._value)
+        failed = False
+        if cached is not None and (not cached[1] or cached[2] >= budget):
+            # Complete, or the same integer already ran out of at least this budget
+            factors, composites, _, effort = cached
         else:
-            factors = timeout(factor, [self._value], timeout_duration=self._timeout_duration)
-            if isinstance(factors, str):
-                self._timeout = True
-                self._factorization = factors
-            else:
-                self._factorization = list(factors)
+            factors, composites, effort = staged_factorization(
+                self._value,
+                budget,
+                self._use_ecm,
+                None if cached is None else cached[0:2] + cached[3:],
+            )
+            failed = effort.pop("failed", False)
+            # A crash does not show that the budget is too small, it is not cached as if it was
+            if not failed:
+                FACTOR_CACHE.put(self._value, factors, composites, budget, effort)
+        self._partial = [(ZZ(p), e) for p, e in factors]
+        self._composites = [ZZ(c) for c in composites]
+        self._effort = effort
+        if failed:
+            self._timeout = True
+            self._factorization = FAILURE_MESSAGE
+        elif composites:
+            self._timeout = True
+            self._factorization = TIMEOUT_MESSAGE
+        else:
+            self._factorization = self._partial
 
     def squarefree(self):
         if self._squarefree is not None:
@@ -99,14 +399,33 @@ class Factorization:
         return ZZ(sqrt(self._value // self.cm_squarefree()))
 
     def __add__(self, other):
+        """Factorization of the product, with the partial factorizations, cofactors and effort of both parts"""
         value = self.value() * other.value()
-        if self.timeout() or other.timeout():
-            return Factorization(value, factorization=self.timeout_message())
-        other_factors = dict(other.factorization(False))
-        factors = [(p, e + other_factors.get(p, 0)) for p, e in self.factorization(False)]
-        self_primes = set(self.factorization())
-        factors += [i for i in other.factorization(False) if not i[0] in self_primes]
-        return Factorization(value, factorization=sorted(factors, key=lambda x: x[0]))
+        exponents = Counter()
+        for p, e in self.partial_factorization(False) + other.partial_factorization(False):
+            exponents[p] += e
+        partial = sorted(exponents.items())
+        if FAILURE_MESSAGE in (self.timeout_message(), other.timeout_message()):
+            product = Factorization(value, factorization=FAILURE_MESSAGE)
+        elif self.timeout() or other.timeout():
+            product = Factorization(value, factorization=TIMEOUT_MESSAGE)
+        else:
+            product = Factorization(value, factorization=partial)
+        product._partial = partial
+        product._composites = sorted(self.cofactors() + other.cofactors())
+        product._effort = merge_effort(self, other)
+        return product
+
+
+def merge_effort(*parts):
+    """Effort spent on the factorizations of the parts of a product: the seconds of all of them, and how far the
+    cofactors left were pushed, i.e. by the least effort among the parts with cofactors"""
+    efforts = [part.effort() for part in parts]
+    effort = {"seconds": sum(e.get("seconds", 0.0) for e in efforts)}
+    left = [part.effort() for part in parts if part.cofactors()] or efforts
+    effort["rho"] = all(e.get("rho", False) for e in left)
+    effort["ecm"] = min(e.get("ecm", 0) for e in left)
+    return effort
 
 
 def customize_curve(curve):
@@ -146,12 +465,21 @@ def customize_curve(curve):
 
 
 def timeout(func, args=(), kwargs=None, timeout_duration=10):
-    """Stops the function func after 'timeout_duration' seconds, taken from
+    """Stops the function func after 'timeout_duration' seconds. Runs inline when the history of similar calls
+    predicts it to be cheap, in the helper process of the timeout pool otherwise, or in a fork when func or its
+    arguments cannot be sent there, taken from
     https://ask.sagemath.org/question/10112/kill-the-thread-in-a-long-computation/."""
     if kwargs is None:
         kwargs = {}
 
-    @fork(timeout=timeout_duration, verbose=False)
+    def sandboxed(duration):
+        return TIMEOUT_POOL.call(func, args, kwargs, duration)
+
+    result = INLINE_PREDICTOR.call(func, args, kwargs, timeout_duration * _timeout_scale, sandboxed)
+    if result is not UNAVAILABLE:
+        return result
+
+    @fork(timeout=timeout_duration * _timeout_scale, verbose=False)
     def my_new_func():
         return func(*args, **kwargs)
 